@@ -18,26 +18,84 @@ Todo:
 """
 
 
-from docx import *
+import os
 import argparse
 import re
 import csv
 import sys
 import json
-import inspect
 import logging
-from curses import ascii
 import fnmatch
+import itertools
+import copy
+import collections
+import time
+import resource
+import importlib
+import tempfile
+import zipfile
+import hashlib
+import cPickle
+import cProfile
+import inspect
+import mmap
+import threading
+import Queue
+import zlib
+import shutil
+import cStringIO
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Only on python 3
+
+
+class LazyModule():
+    """Stand-in for a module that is imported on first attribute access
+
+    Keeps docx/lxml, PIL, the optional input libraries, multiprocessing and
+    sqlite3 out of startup, so --help, settings validation and --check never
+    pay for them.  Cheap stdlib modules are imported as usual."""
+
+    def __init__(self, name):
+        self.lazy_name = name
+        self.lazy_module = None
+    # end __init__
+
+    def __getattr__(self, attr):
+        if self.lazy_module is None:
+            self.lazy_module = importlib.import_module(self.lazy_name)
+        value = getattr(self.lazy_module, attr)
+        setattr(self, attr, value) # Later lookups skip __getattr__
+        return value
+    # end __getattr__
+# LazyModule
+
+docx = LazyModule('docx')
+etree = LazyModule('lxml.etree')
+multiprocessing = LazyModule('multiprocessing')
+mp_pool = LazyModule('multiprocessing.pool')
+sqlite3 = LazyModule('sqlite3')
+openpyxl = LazyModule('openpyxl') # Optional, for xlsx input
+pyarrow = LazyModule('pyarrow') # Optional, for parquet/arrow input
+parquet = LazyModule('pyarrow.parquet')
+ipc = LazyModule('pyarrow.ipc')
+Image = LazyModule('PIL.Image')
+ImageOps = LazyModule('PIL.ImageOps')
 
 THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
 FORMAT = '%(asctime)-15s %(module)s %(funcName)s %(message)s'
-logging.basicConfig(format=FORMAT,
-                    filename=os.path.join(THIS_FOLDER, 'temp.log'))
 log = logging.getLogger()
 
 DEFAULT_JSON = 'test/test_settings.json'
 DEFAULT_INPUT_FILE = 'test/input.csv'
 DEFAULT_OUTPUT_FILE = 'test/output.docx'
+PARALLEL_CHUNK_ROWS = 500 # Rows per task sent to each --jobs worker
+CHECKPOINT_ROWS = 1000 # Rows rendered between --checkpoint saves
+PIPELINE_CHUNK_ROWS = 100 # Rows passed between --pipeline threads at a time
+PIPELINE_QUEUE_CHUNKS = 4 # Chunks each --pipeline stage may run ahead
+DEFLATE_CHUNK = 2 ** 16 # Bytes of xml handed to the deflate thread at a time
+DEFLATE_BLOCK = 2 ** 18 # Bytes of word/document.xml per --deflate-threads task
 
 class LogicError(Exception):
     pass
@@ -50,7 +108,8 @@ def create_parser():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("--input", "-i",
-                        help="input csv filename",
+                        help="input filename: csv, or xlsx, sqlite, parquet or "
+                             "arrow by extension (or the input_format setting)",
                         default=DEFAULT_INPUT_FILE)
     parser.add_argument("--output", "-o",
                         help='output docx filename',
@@ -58,9 +117,102 @@ def create_parser():
     parser.add_argument("--settings", "-s",
                         help='settings file (json)',
                         default=DEFAULT_JSON)
+    parser.add_argument("--jobs", "-j",
+                        help='worker processes used to clean, resolve and render rows',
+                        type=int,
+                        default=1)
+    parser.add_argument("--check",
+                        help='only validate the input: report dangling references, '
+                             'bad or duplicate ids, bad heading levels and missing '
+                             'images, without building a docx',
+                        action='store_true')
+    parser.add_argument("--split",
+                        help='write one docx per heading of this level (or above), '
+                             'named like OUTPUT-01.docx; --jobs renders them '
+                             'concurrently',
+                        metavar='LEVEL', type=int)
+    parser.add_argument("--serve",
+                        help='run a local conversion service on [HOST:]PORT; '
+                             'see csv2docx_server.py',
+                        metavar='ADDRESS')
+    parser.add_argument("--debug-csv",
+                        help="write the debug trace of resolved tokens here ('-' "
+                             "for stdout); by default OUTPUT.debug.csv if the "
+                             "settings set debug",
+                        metavar='PATH')
+    parser.add_argument("--no-debug-csv",
+                        help='never write the debug trace',
+                        action='store_false', dest='debug_csv_enabled')
+    parser.add_argument("--checkpoint",
+                        help='save progress to this folder every %d rows, so an '
+                             'interrupted conversion can be finished with '
+                             '--resume' % CHECKPOINT_ROWS,
+                        metavar='DIR')
+    parser.add_argument("--resume",
+                        help='continue from the progress saved in --checkpoint',
+                        action='store_true')
+    parser.add_argument("--batch", "-b",
+                        help='manifest (json or csv) of input, output and settings '
+                             'files to convert in this one process; --jobs sets '
+                             'the number of files converted at once')
+    parser.add_argument("--summary",
+                        help='where --batch writes its json summary of timings '
+                             'and failures (default: stdout)')
+    parser.add_argument("--cache-dir",
+                        help='keep rendered rows here between runs and only '
+                             're-render rows that changed (ignores --jobs)')
+    parser.add_argument("--profile",
+                        help='write a json report of calls, wall/cpu time and '
+                             'peak memory for each pipeline stage to this file')
+    parser.add_argument("--profile-dump",
+                        help='also write cProfile stats (pstats format) to this '
+                             'file, and trace allocations if tracemalloc exists')
+    parser.add_argument("--stream",
+                        help='two-pass streaming mode; only the cross-reference '
+                             'index (row ids and headings) is held in memory',
+                        action='store_true')
+    parser.add_argument("--stream-docx",
+                        help='serialize the document body as it is written '
+                             'instead of keeping the whole tree until save',
+                        action='store_true')
+    parser.add_argument("--pipeline",
+                        help='read, resolve and render rows on separate threads, '
+                             'prefetching images and compressing the document '
+                             'as it is written (implies --stream and --stream-docx)',
+                        action='store_true')
+    parser.add_argument("--image-jobs",
+                        help='processes downscaling/re-encoding images when the '
+                             'settings ask for it (default: one per cpu)',
+                        type=int)
+    parser.add_argument("--deflate-threads",
+                        help='threads compressing word/document.xml on save '
+                             '(the output is a little larger)',
+                        type=int,
+                        default=1)
+    parser.add_argument("--ids",
+                        help='only export these row ids, e.g. 5,100-250, read '
+                             'through the INPUT.idx row index (csv input only)',
+                        type=id_ranges)
+    parser.add_argument("--section",
+                        help='only export the section with this heading number, '
+                             'e.g. 3.2, read through the INPUT.idx row index',
+                        metavar='NUMBER')
 
     return parser
 
+def id_ranges(text):
+    """ argparse type for --ids: '5,100-250' -> [(5, 5), (100, 250)] """
+    ranges = []
+    try:
+        for part in text.split(','):
+            first, _, last = part.strip().partition('-')
+            ranges.append((int(first), int(last or first)))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ids like 5,100-250, not '%s'" %
+                                         text)
+    return ranges
+# end id_ranges
+
 class utils():
 
     @staticmethod
@@ -98,7 +250,21 @@ class MySettings():
     heading_num_ind = None
     heading_text_ind = None
     body_text_ind = None
-    all_inds = []
+    all_inds = ()
+    profile = None # SettingsProfile, set by validate_set_json_dict
+    input_format = None # Default from the input file extension; see ROW_SOURCES
+    input_sheet = None # xlsx worksheet name; default the active sheet
+    input_query = None # sqlite query; default every row of the first table
+    csv_dialect = None # csv.reader dialect name or dict; None maps excel csv
+    newline_mode = 'paragraph' # Or 'break': one paragraph, w:br between lines
+    deflate_levels = {} # Part type -> zlib level, 0 stores; see DocxPackage
+    store_compressed_media = True # Store png/jpeg/gif media as they are
+    image_max_width = None # Inches of page an image may fill; see ImagePreprocessor
+    image_max_dpi = None # Pixels kept per inch of that width
+    image_max_pixels = None # Pixels kept on the longest side
+    image_format = None # 'jpeg' or 'png' re-encodes every image
+    image_jpeg_quality = 85
+    image_cache_dir = None # Default: csv2docx-images in the temp folder
 
     def json_file_to_dict(self, json_filename):
         try:
@@ -122,13 +288,31 @@ class MySettings():
                     ("l_delim ('%s') and r_delim ('%s') need to be single characters\nExiting..." %
                      (settings['l_delim'], settings['r_delim'])))
 
-            self.all_inds.append(self.id_ind)
-            self.all_inds.append(self.heading_level_ind)
-            self.all_inds.append(self.heading_num_ind)
-            self.all_inds.append(self.heading_text_ind)
-            self.all_inds.append(self.body_text_ind)
+            if self.newline_mode not in ParagraphBuilder.NEWLINE_MODES:
+                sys.exit("newline_mode ('%s') needs to be one of %s\nExiting..." %
+                         (self.newline_mode, ', '.join(ParagraphBuilder.NEWLINE_MODES)))
+
+            for part_type, level in self.deflate_levels.items():
+                if (part_type not in DocxPackage.PART_TYPES or
+                        level not in range(-1, 10)):
+                    sys.exit("deflate_levels needs levels from -1 to 9 for %s, "
+                             "not %s: %s\nExiting..." %
+                             (', '.join(DocxPackage.PART_TYPES), part_type, level))
+
+            if self.image_format not in ImagePreprocessor.FORMATS:
+                sys.exit("image_format ('%s') needs to be one of %s\nExiting..." %
+                         (self.image_format, ', '.join(map(str, ImagePreprocessor.FORMATS))))
+
+            # Per instance: a class-level list grew with every settings load
+            self.all_inds = [self.id_ind, self.heading_level_ind,
+                             self.heading_num_ind, self.heading_text_ind,
+                             self.body_text_ind]
             # Confirm settings about as expected
 
+            # Compiled once here, rather than per row, and shared by parsers
+            self.profile = SettingsProfile.from_settings(self)
+            self.tokenizer = self.profile.tokenizer
+
         except Exception as ex:
             sys.exit("Unexpected issue in %s\nExiting..." %
                      inspect.stack()[0][3])
@@ -142,18 +326,344 @@ class MySettings():
 # MySettings
 
 
+class SettingsProfile(collections.namedtuple('SettingsProfile',
+        'columns id_ind heading_level_ind heading_num_ind heading_text_ind '
+        'body_text_ind l_delim r_delim heading_text_symbol heading_number_symbol')):
+    """The settings rows are parsed with, frozen once the json is validated
+
+    A tuple of plain values, so it is hashable, usable as a cache key, cheap
+    to pickle to worker processes and safe to share between threads.
+    columns is the sorted tuple of distinct configured column indexes.  The
+    compiled Tokenizer is memoized per profile rather than stored in it, so
+    profiles loaded from equal settings compare (and hash) equal."""
+    __slots__ = ()
+
+    _tokenizers = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        s = settings
+        inds = (s.id_ind, s.heading_level_ind, s.heading_num_ind,
+                s.heading_text_ind, s.body_text_ind)
+        return cls(tuple(sorted(set(inds))), *(inds + (
+            s.l_delim, s.r_delim, s.heading_text_symbol, s.heading_number_symbol)))
+    # end from_settings
+
+    @property
+    def tokenizer(self):
+        tokenizer = self._tokenizers.get(self)
+        if tokenizer is None:
+            # setdefault keeps one Tokenizer if two threads race here
+            tokenizer = self._tokenizers.setdefault(self, Tokenizer(self))
+        return tokenizer
+    # end tokenizer
+# SettingsProfile
+
+
+class Tokenizer():
+    """ Splits body text on delimited tokens in one precompiled regex pass
+
+    tokenize() returns a flat token stream from a single re.split call: a
+    text segment, then STRIDE - 1 fields describing the token that follows
+    it, repeating, and always ending with a text segment.  The token fields
+    are (symbol, digits, None) for heading references like {#7} or {H7}, and
+    (None, None, contents) for anything else in delimiters (images, notes,
+    tables...)."""
+
+    STRIDE = 4
+
+    def __init__(self, settings):
+        s = settings
+        symbols = '|'.join(re.escape(symbol) for symbol in
+                           (s.heading_text_symbol, s.heading_number_symbol))
+        self.pattern = re.compile('%s(?:(%s)(\d+)|([^%s]*))%s' %
+                                  (re.escape(s.l_delim), symbols,
+                                   re.escape(s.r_delim), re.escape(s.r_delim)))
+    # end __init__
+
+    def tokenize(self, body):
+        return self.pattern.split(body)
+    # end tokenize
+
+    def parse(self, token):
+        """ Return the (symbol, digits, contents) fields of a single token """
+        match = self.pattern.match(token)
+        if match is None or match.end() != len(token):
+            raise LogicError('%s was passed a malformed token, %s' %
+                             (inspect.stack()[0][3], token))
+        return match.groups()
+    # end parse
+# Tokenizer
+
+
+class ImageCache():
+    """Pictures keyed by image content, so each unique image is embedded once
+
+    Files are hashed once per (path, mtime, size); the first file with a
+    given hash is the one embedded, and repeat references reuse its
+    relationship id, media part and picture element."""
+
+    def __init__(self):
+        self.digests = {}
+        self.paths = {}
+        self.pictures = {}
+        self.hits = 0
+        self.misses = 0
+    # end __init__
+
+    def digest(self, image_file):
+        stat = os.stat(image_file)
+        key = (os.path.abspath(image_file), stat.st_mtime, stat.st_size)
+        if key not in self.digests:
+            sha = hashlib.sha1()
+            with open(image_file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), ''):
+                    sha.update(block)
+            self.digests[key] = sha.hexdigest()
+        return self.digests[key]
+    # end digest
+
+    def stats(self):
+        return {'image_cache_hits': self.hits,
+                'image_cache_misses': self.misses}
+    # end stats
+# ImageCache
+
+
+class ImagePreprocessor():
+    """Downscaled or re-encoded copies of images, made ahead and cached on disk
+
+    docx shows an image at 72 pixels per inch.  With image_max_width an
+    image is shown at most that many inches wide, and image_max_dpi and
+    image_max_pixels cap the pixels kept for it; image_format re-encodes
+    it as jpeg or optimized png.  Results are kept in image_cache_dir under
+    a key of the image content and these settings, so each image is only
+    processed once.  prefetch() hands images to a pool of processes as soon
+    as they are known, and get() returns the file to embed and the size to
+    show it at."""
+
+    VERSION = '1' # Bump when processing changes, to invalidate old caches
+    FORMATS = (None, 'jpeg', 'png')
+    POINTS_PER_INCH = 72 # docx.picture's pixel size
+
+    def __init__(self, settings):
+        s = settings
+        self.params = self.params_from(settings)
+        self.cache_dir = s.image_cache_dir or os.path.join(tempfile.gettempdir(),
+                                                           'csv2docx-images')
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass # Made by a concurrent conversion
+        self.pool = None
+        self.pending = {}
+        self.results = {}
+    # end __init__
+
+    @classmethod
+    def params_from(cls, settings):
+        """ The settings images are processed with, or None for none """
+        s = settings
+        if (s.image_max_width is None and s.image_max_dpi is None and
+                s.image_max_pixels is None and s.image_format is None):
+            return None
+        return (cls.VERSION, s.image_max_width, s.image_max_dpi,
+                s.image_max_pixels, s.image_format, s.image_jpeg_quality)
+    # end params_from
+
+    @classmethod
+    def from_settings(cls, settings):
+        """ Return an ImagePreprocessor, or None if the settings need none """
+        if cls.params_from(settings) is None:
+            return None
+        return cls(settings)
+    # end from_settings
+
+    def start(self, jobs=None):
+        """ Process prefetched images in a pool of jobs processes """
+        # Pool workers (--split, --serve) can't have children; get() works inline
+        if jobs != 1 and not multiprocessing.current_process().daemon:
+            self.pool = multiprocessing.Pool(jobs)
+    # end start
+
+    def prefetch(self, image_file):
+        image_path = os.path.abspath(image_file)
+        if (self.pool is not None and image_path not in self.pending and
+                image_path not in self.results):
+            self.pending[image_path] = self.pool.apply_async(
+                preprocess_image, (image_path, self.params, self.cache_dir))
+    # end prefetch
+
+    def get(self, image_file):
+        """ Return (file to embed, (width, height) to show it at) """
+        image_path = os.path.abspath(image_file)
+        result = self.results.get(image_path)
+        if result is None:
+            pending = self.pending.pop(image_path, None)
+            if pending is not None:
+                result = pending.get()
+            else:
+                result = preprocess_image(image_path, self.params, self.cache_dir)
+            self.results[image_path] = result
+        return result
+    # end get
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending = {}
+    # end close
+# ImagePreprocessor
+
+def preprocess_image(image_file, params, cache_dir):
+    """Return (file to embed, display size) for image_file; see ImagePreprocessor
+
+    The display size is in docx.picture's 72-per-inch pixels.  The file is
+    image_file itself when it needs no change."""
+    sha = hashlib.sha1(repr(params))
+    with open(image_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            sha.update(block)
+    key = sha.hexdigest()
+    meta_file = os.path.join(cache_dir, key + '.json')
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['file'] is None:
+            return image_file, tuple(meta['size'])
+        cache_file = os.path.join(cache_dir, meta['file'])
+        if os.path.isfile(cache_file):
+            return cache_file, tuple(meta['size'])
+    except (IOError, ValueError, KeyError):
+        pass # Not cached yet
+
+    version, max_width, max_dpi, max_pixels, image_format, quality = params
+    image = Image.open(image_file)
+    original_format = image.format
+    changed = False
+    if image.getexif().get(0x0112, 1) != 1:
+        # Re-encoding drops the exif orientation, so apply it first
+        image = ImageOps.exif_transpose(image)
+        changed = True
+
+    width, height = image.size
+    points = ImagePreprocessor.POINTS_PER_INCH
+    display_width = width
+    if max_width is not None:
+        display_width = min(width, int(max_width * points))
+    display = (display_width, max(1, int(round(height * display_width / float(width)))))
+    pixel_width = width
+    if max_dpi is not None:
+        pixel_width = min(pixel_width, int(round(display_width / float(points) * max_dpi)))
+    if max_pixels is not None:
+        pixel_width = min(pixel_width, int(max_pixels * width / max(width, height)))
+    if pixel_width < width:
+        image = image.resize((max(1, pixel_width),
+                              max(1, int(round(height * pixel_width / float(width))))),
+                             Image.LANCZOS)
+        changed = True
+
+    if image_format is None and changed:
+        image_format = 'jpeg' if original_format == 'JPEG' else 'png'
+    cache_name = None
+    if image_format is not None:
+        stem = os.path.splitext(os.path.basename(image_file))[0]
+        cache_name = '%s-%s.%s' % (stem, key[:16], 'jpg' if image_format == 'jpeg' else 'png')
+        cache_file = os.path.join(cache_dir, cache_name)
+        temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        if image_format == 'jpeg':
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # No alpha in jpeg: flatten onto white, as a page would show it
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[3])
+                image = background
+            elif image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(temp_file, 'JPEG', quality=quality, optimize=True)
+        else:
+            image.save(temp_file, 'PNG', optimize=True)
+        if not changed and os.path.getsize(temp_file) >= os.path.getsize(image_file):
+            os.remove(temp_file) # Re-encoding alone didn't help
+            cache_name = None
+        else:
+            os.rename(temp_file, cache_file) # Atomic, for concurrent conversions
+
+    temp_file = '%s.%d.tmp' % (meta_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump({'file': cache_name, 'size': display}, f)
+    os.rename(temp_file, meta_file)
+    if cache_name is None:
+        return image_file, display
+    return os.path.join(cache_dir, cache_name), display
+# end preprocess_image
+
+
+class ParagraphBuilder():
+    """Body paragraphs cloned from one prebuilt w:p, instead of docx.paragraph
+
+    paragraph(text) makes the same xml as docx.paragraph(text) without its
+    per-call element and style construction.  lines(lines) puts several
+    lines in one paragraph, separated by w:br line breaks."""
+
+    NEWLINE_MODES = ('paragraph', 'break')
+    XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+    def __init__(self):
+        self.template = docx.paragraph('')
+        w_namespace = '{%s}' % docx.nsprefixes['w']
+        self.t_tag = w_namespace + 't'
+        self.br_tag = w_namespace + 'br'
+    # end __init__
+
+    def set_text(self, text_element, text):
+        if text:
+            text_element.text = text
+            if len(text.strip()) < len(text):
+                text_element.set(self.XML_SPACE, 'preserve')
+    # end set_text
+
+    def paragraph(self, text):
+        paragraph = copy.deepcopy(self.template)
+        self.set_text(paragraph[1][1], text) # p/r/t
+        return paragraph
+    # end paragraph
+
+    def lines(self, lines):
+        paragraph = copy.deepcopy(self.template)
+        run = paragraph[1]
+        self.set_text(run[1], lines[0])
+        for line in lines[1:]:
+            etree.SubElement(run, self.br_tag)
+            self.set_text(etree.SubElement(run, self.t_tag), line)
+        return paragraph
+    # end lines
+# ParagraphBuilder
+
+
 class DocxConfig():
+    journal = None # List of appended elements, while a Checkpoint needs them
+    deflate_threads = 1 # Threads deflating word/document.xml in save()
+
     def __init__(self, settings):
         self.s = settings
+        self.paragraphs = ParagraphBuilder()
 
         # Default set of relationshipships - the minimum components of a document
-        self.relationships = relationshiplist()
+        self.relationships = docx.relationshiplist()
+        # Embedded image path -> relationship id, and picture reuse
+        self.imagefiledict = {}
+        self.image_cache = ImageCache()
+        self.images = ImagePreprocessor.from_settings(settings)
 
         # Make a new document tree - this is the main part of a Word document
-        self.document = newdocument()
+        self.document = docx.newdocument()
 
         # This xpath location is where most interesting content lives
-        self.body = self.document.xpath('/w:document/w:body', namespaces=nsprefixes)[0]
+        self.body = self.document.xpath('/w:document/w:body', namespaces=docx.nsprefixes)[0]
     # end __init__
 
     def valid_character(self, i):
@@ -170,74 +680,1072 @@ class DocxConfig():
             )
     # end valid_character
 
+    def append(self, element):
+        """ Add element to the end of the document body """
+        self.body.append(element)
+        if self.journal is not None:
+            self.journal.append(element)
+    # end append
+
     def add_image(self, image_file, image_caption):
-        self.relationships, picpara = picture(self.relationships,
-                                              image_file,
-                                              image_caption)
-        self.body.append(picpara)
+        cache = self.image_cache
+        key = (cache.digest(image_file), image_caption)
+        picpara = cache.pictures.get(key)
+        if picpara is None:
+            cache.misses += 1
+            image_path = cache.paths.setdefault(key[0], os.path.abspath(image_file))
+            width = height = None # From the image
+            if self.images is not None:
+                image_path, (width, height) = self.images.get(image_path)
+            self.relationships, picpara, self.imagefiledict = docx.picture(
+                self.relationships, image_path, image_caption, width, height,
+                imagefiledict=self.imagefiledict)
+            cache.pictures[key] = picpara
+        else:
+            cache.hits += 1
+        self.append(copy.deepcopy(picpara))
     # end add_image
 
-    def save(self, out_file):
+    def support_parts(self):
+        """ Return the (tree, archive name) pairs other than the document """
         s = self.s
         # Create our properties, contenttypes, and other support files
-
-        coreprops = coreproperties(title=s.title,
+        coreprops = docx.coreproperties(title=s.title,
                                    subject=s.subject,
                                    creator=s.creator,
                                    keywords=s.keywords)
-        appprops = appproperties()
-        content_types = contenttypes()
-        web_settings = websettings()
-        word_relationships = wordrelationships(self.relationships)
-
-        # print 'About to save'
-        # Save our document
-        savedocx(self.document, coreprops, appprops, content_types, web_settings,
-                 word_relationships, out_file)
+        return [(coreprops, 'docProps/core.xml'),
+                (docx.appproperties(), 'docProps/app.xml'),
+                (docx.contenttypes(), '[Content_Types].xml'),
+                (docx.websettings(), 'word/webSettings.xml'),
+                (docx.wordrelationships(self.relationships),
+                 'word/_rels/document.xml.rels')]
+    # end support_parts
+
+    def write_document(self, package):
+        """ Add word/document.xml to package, a DocxPackage """
+        data = etree.tostring(self.document, pretty_print=True)
+        package.write_blocks('word/document.xml', len(data),
+                             (data[i:i + DEFLATE_BLOCK]
+                              for i in xrange(0, len(data), DEFLATE_BLOCK)),
+                             DocxPackage.DOCUMENT, self.deflate_threads)
+    # end write_document
+
+    def save(self, out_file):
+        # The parts docx.savedocx writes, compressed as the settings say
+        package = DocxPackage(out_file, self.s)
+        try:
+            self.write_document(package)
+            for tree, archive_name in self.support_parts():
+                package.writestr(archive_name,
+                                 etree.tostring(tree, pretty_print=True))
+            for image_path, picrelid in self.imagefiledict.items():
+                package.write_media(image_path, 'word/media/%s_%s' %
+                                    (picrelid, os.path.basename(image_path)))
+            for archive_name, data in template_parts():
+                package.writestr(archive_name, data)
+        finally:
+            package.close()
     # end save
 
+    # Printable ascii maps to itself, newline and carriage return map to
+    # newline, and everything else becomes '?'
+    CLEAN_TABLE = ''.join(
+        (0x20 <= i <= 0x7E and chr(i)) or
+        ((i == 0xA or i == 0xD) and '\n') or
+        '?' for i in range(256))
+    # curses.ascii.isprint is always False for unicode characters, so the
+    # original per-character clean turned all but newlines into '?'
+    UNICODE_CLEAN_TABLE = ''.join(
+        ((i == 0xA or i == 0xD) and '\n') or
+        '?' for i in range(256))
+
     @staticmethod
     def clean(text):
         try:
-            clean_text = str(''.join(
-                (ascii.isprint(c) and c) or
-                ((c == '\n' or c == '\r') and '\n') or
-                '?' for c in text
-                ))
-                # curses.unctrl(c) for c in text
-            return clean_text
+            if isinstance(text, unicode):
+                return text.encode('ascii', 'replace').translate(
+                    DocxConfig.UNICODE_CLEAN_TABLE)
+            return text.translate(DocxConfig.CLEAN_TABLE)
         except Exception as ex:
             print ('WARNING: Unexpected error encountered in %s' %
                    inspect.stack()[0][3])
             raise # Don't catch all without raising
     # end clean
 
+    def append_xml(self, xml):
+        """ Append the elements of a body fragment from a FragmentRecorder """
+        for element in list(etree.fromstring(xml)):
+            self.append(element)
+    # end append_xml
+
     def write_heading(self, heading_text, heading_level):
-        self.body.append(heading(heading_text,
-                                 heading_level))
+        self.append(docx.heading(heading_text,
+                            heading_level))
 
     def write_paragraph(self, para, row_id):
         try:
             if len(para):
-                # TODO: implement separate paragraphs where newlines were included
-                # see http://stackoverflow.com/a/14422406/527489
-                for para_text in para.split('\n'):
-                    self.body.append(paragraph(para_text))
+                if self.s.newline_mode == 'break':
+                    self.append(self.paragraphs.lines(para.split('\n')))
+                else:
+                    for para_text in para.split('\n'):
+                        self.append(self.paragraphs.paragraph(para_text))
         except Exception as ex:
             err_msg = 'Failed to write paragraph with id %s' % row_id
-            self.body.append(paragraph(err_msg))
+            self.append(docx.paragraph(err_msg))
             log.warning(err_msg)
             log.info(ex)
             raise # Don't catch all without raising
     # end write_paragraph
 # DocxConfig
 
-class CsvParser():
+_template_parts = None
+
+def template_parts():
+    """Return (archive name, bytes) for the static parts of the docx template
+
+    These are the files savedocx copies from docx.template_dir on every
+    save; they are read once per process and kept in memory."""
+    global _template_parts
+    if _template_parts is None:
+        parts = []
+        for dirpath, dirnames, filenames in os.walk(docx.template_dir):
+            for filename in filenames:
+                if filename == '.DS_Store':
+                    continue
+                template_file = os.path.join(dirpath, filename)
+                with open(template_file, 'rb') as f:
+                    parts.append((os.path.relpath(template_file, docx.template_dir),
+                                  f.read()))
+        _template_parts = parts
+    return _template_parts
+# end template_parts
+
+
+class DocxPackage():
+    """The zip of a docx, written with a deflate level for each type of part
+
+    Python 2's zipfile deflates every member at zlib's default level, so
+    parts are compressed here and written the way ZipFile.write writes
+    them.  The part types are DOCUMENT (word/document.xml), XML (the other
+    parts) and MEDIA; the deflate_levels setting maps them to a zlib level,
+    where 0 stores a part.  With store_compressed_media, png/jpeg/gif media
+    are always stored, since deflating them again only costs time."""
+
+    DOCUMENT = 'document'
+    XML = 'xml'
+    MEDIA = 'media'
+    PART_TYPES = (DOCUMENT, XML, MEDIA)
+    COMPRESSED_MEDIA = ('.png', '.jpg', '.jpeg', '.gif')
+
+    def __init__(self, out_file, settings):
+        self.s = settings
+        self.zip = zipfile.ZipFile(out_file, mode='w',
+                                   compression=zipfile.ZIP_DEFLATED,
+                                   allowZip64=True)
+    # end __init__
+
+    def level(self, part_type):
+        return self.s.deflate_levels.get(part_type, zlib.Z_DEFAULT_COMPRESSION)
+    # end level
+
+    def begin_entry(self, archive_name, compress_type, size):
+        """ Write the local header of a member; end_entry completes it """
+        zinfo = zipfile.ZipInfo(archive_name, time.localtime(time.time())[:6])
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0600 << 16
+        zinfo.file_size = size
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.header_offset = self.zip.fp.tell()
+        self.zip._writecheck(zinfo)
+        self.zip._didModify = True
+        zip64 = size * 1.05 > zipfile.ZIP64_LIMIT # As ZipFile.write guesses
+        self.zip.fp.write(zinfo.FileHeader(zip64))
+        return zinfo, zip64
+    # end begin_entry
+
+    def end_entry(self, entry, crc, compress_size):
+        """ Rewrite the local header with the crc and size, and list it """
+        zinfo, zip64 = entry
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.compress_size = compress_size
+        end = self.zip.fp.tell()
+        self.zip.fp.seek(zinfo.header_offset)
+        self.zip.fp.write(zinfo.FileHeader(zip64))
+        self.zip.fp.seek(end)
+        self.zip.filelist.append(zinfo)
+        self.zip.NameToInfo[zinfo.filename] = zinfo
+    # end end_entry
+
+    def write_blocks(self, archive_name, size, blocks, part_type=XML, threads=1):
+        """Add the member made of blocks, size bytes of strings in all
+
+        With threads > 1 the blocks are deflated concurrently (zlib releases
+        the GIL), each ending on a byte boundary with a sync flush so their
+        output can be joined into one stream, as pigz does.  Blocks don't
+        share a dictionary, so the result is a little larger."""
+        level = self.level(part_type)
+        if level == 0:
+            entry = self.begin_entry(archive_name, zipfile.ZIP_STORED, size)
+            compressed = ((block, block) for block in blocks)
+        else:
+            entry = self.begin_entry(archive_name, zipfile.ZIP_DEFLATED, size)
+            compressed = self.deflate_blocks(blocks, level, threads)
+        crc = 0
+        compress_size = 0
+        for block, data in compressed:
+            crc = zlib.crc32(block, crc)
+            self.zip.fp.write(data)
+            compress_size += len(data)
+        self.end_entry(entry, crc, compress_size)
+    # end write_blocks
+
+    @staticmethod
+    def deflate_blocks(blocks, level, threads=1):
+        """ Yield (block, deflated data) pairs, then ('', end of stream) """
+        if threads > 1:
+            def deflate_block(block):
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                return block, (compressor.compress(block) +
+                               compressor.flush(zlib.Z_SYNC_FLUSH))
+            pool = mp_pool.ThreadPool(threads)
+            try:
+                for pair in pool.imap(deflate_block, blocks):
+                    yield pair
+            finally:
+                pool.terminate()
+            # An empty final block ends the stream
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            for block in blocks:
+                yield block, compressor.compress(block)
+        yield '', compressor.flush()
+    # end deflate_blocks
+
+    def writestr(self, archive_name, data, part_type=XML):
+        self.write_blocks(archive_name, len(data), [data], part_type)
+    # end writestr
+
+    def write_file(self, path, archive_name, part_type=XML, threads=1):
+        with open(path, 'rb') as f:
+            self.write_blocks(archive_name, os.fstat(f.fileno()).st_size,
+                              iter(lambda: f.read(DEFLATE_BLOCK), ''),
+                              part_type, threads)
+    # end write_file
+
+    def write_media(self, path, archive_name):
+        if (self.s.store_compressed_media and
+                os.path.splitext(path)[1].lower() in self.COMPRESSED_MEDIA):
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                entry = self.begin_entry(archive_name, zipfile.ZIP_STORED, size)
+                crc = 0
+                for block in iter(lambda: f.read(DEFLATE_BLOCK), ''):
+                    crc = zlib.crc32(block, crc)
+                    self.zip.fp.write(block)
+            self.end_entry(entry, crc, size)
+        else:
+            self.write_file(path, archive_name, self.MEDIA)
+    # end write_media
+
+    def write_deflated(self, archive_name, deflated):
+        """ Add the already deflated data of a closed DeflateWriter """
+        entry = self.begin_entry(archive_name, zipfile.ZIP_DEFLATED, deflated.size)
+        deflated.file.seek(0)
+        shutil.copyfileobj(deflated.file, self.zip.fp, DEFLATE_CHUNK)
+        deflated.file.close()
+        self.end_entry(entry, deflated.crc, deflated.compress_size)
+    # end write_deflated
+
+    def close(self):
+        self.zip.close()
+    # end close
+# DocxPackage
+
+
+class DeflateWriter():
+    """File-like object that deflates what is written to it on a thread
+
+    write() only queues the data in DEFLATE_CHUNK pieces; a background
+    thread compresses them into a temporary file, keeping the crc and
+    sizes a zip entry needs, so compression overlaps with whatever produces
+    the data.  close() waits for the thread and re-raises its error, if
+    any; DocxPackage.write_deflated then adds the result to a zip."""
+
+    def __init__(self, level=-1):
+        self.level = level # zlib level; -1 is the zlib default
+        self.file = tempfile.TemporaryFile()
+        self.crc = 0
+        self.size = 0
+        self.compress_size = 0
+        self.error = None
+        self.pending = []
+        self.pending_size = 0
+        self.queue = Queue.Queue(16)
+        self.thread = threading.Thread(target=self.run, name='deflate')
+        self.thread.daemon = True
+        self.thread.start()
+    # end __init__
+
+    def run(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is not None:
+                continue # Keep draining so write() never blocks
+            try:
+                self.crc = zlib.crc32(data, self.crc)
+                self.size += len(data)
+                self.file.write(compressor.compress(data)) # Releases the GIL
+            except Exception as ex:
+                self.error = ex
+        if self.error is None:
+            try:
+                self.file.write(compressor.flush())
+            except Exception as ex:
+                self.error = ex
+    # end run
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= DEFLATE_CHUNK:
+            self.queue.put(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+    # end write
+
+    def close(self):
+        if self.thread.is_alive():
+            if self.pending:
+                self.queue.put(''.join(self.pending))
+                self.pending = []
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.compress_size = self.file.tell()
+    # end close
+# DeflateWriter
+
+
+class StreamingDocxConfig(DocxConfig):
+    """DocxConfig that never holds the document tree
+
+    Each body element is serialized as soon as it is written, with lxml's
+    incremental xmlfile writer, to a temporary word/document.xml.  save()
+    closes the document and zips it with the parts that depend on the final
+    relationship list.  (Like DocxConfig, it is only told where the docx
+    goes by save(), and a conversion that fails before then leaves no
+    partial output, hence the temporary file rather than writing straight
+    into the output zip.)  With deflate_thread, the body is compressed on a
+    DeflateWriter thread while it is written instead."""
+
+    def __init__(self, settings, deflate_thread=False):
+        self.s = settings
+        self.paragraphs = ParagraphBuilder()
+        self.relationships = docx.relationshiplist()
+        self.imagefiledict = {}
+        self.image_cache = ImageCache()
+        self.images = ImagePreprocessor.from_settings(settings)
+        self.document = None
+        self.body = None
+
+        if deflate_thread:
+            self.body_file = DeflateWriter(
+                settings.deflate_levels.get(DocxPackage.DOCUMENT, -1))
+        else:
+            self.body_file = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        self.open_contexts = []
+        self.xf = self.enter(etree.xmlfile(self.body_file, encoding='UTF-8'))
+        self.xf.write_declaration(standalone=True)
+        w_namespace = docx.nsprefixes['w']
+        self.enter(self.xf.element('{%s}document' % w_namespace,
+                                   nsmap={'w': w_namespace}))
+        self.enter(self.xf.element('{%s}body' % w_namespace))
+    # end __init__
+
+    def enter(self, context):
+        """ Enter an xmlfile context that stays open until save() """
+        self.open_contexts.append(context)
+        return context.__enter__()
+    # end enter
+
+    def append(self, element):
+        self.xf.write(element)
+        if self.journal is not None:
+            self.journal.append(element)
+    # end append
+
+    def write_document(self, package):
+        if isinstance(self.body_file, DeflateWriter):
+            package.write_deflated('word/document.xml', self.body_file)
+        else:
+            package.write_file(self.body_file.name, 'word/document.xml',
+                               DocxPackage.DOCUMENT, self.deflate_threads)
+    # end write_document
+
+    def save(self, out_file):
+        try:
+            while self.open_contexts:
+                self.open_contexts.pop().__exit__(None, None, None)
+            self.body_file.close()
+            DocxConfig.save(self, out_file)
+        finally:
+            if not isinstance(self.body_file, DeflateWriter):
+                os.remove(self.body_file.name)
+    # end save
+
+    def discard(self):
+        """ Drop the partial body of a conversion that failed """
+        # Close the xmlfile contexts before their file; lxml crashes the
+        # interpreter if it finalizes them once the file is gone
+        while self.open_contexts:
+            try:
+                self.open_contexts.pop().__exit__(None, None, None)
+            except Exception:
+                pass # The conversion's own error is the one worth reporting
+        try:
+            self.body_file.close()
+        except Exception:
+            pass
+        if isinstance(self.body_file, DeflateWriter):
+            self.body_file.file.close()
+        else:
+            os.remove(self.body_file.name)
+    # end discard
+# StreamingDocxConfig
+
+class FragmentRecorder(DocxConfig):
+    """Stands in for DocxConfig in --jobs worker processes
+
+    Body elements are serialized to xml fragments instead of kept, and images
+    are only recorded by name: relationship ids depend on the order images
+    are added, so the parent process adds them while stitching fragments into
+    the real DocxConfig."""
+
+    XML_OP = 'xml'
+    IMAGE_OP = 'image'
+
+    def __init__(self, settings):
+        DocxConfig.__init__(self, settings)
+        self.ops = []
+    # end __init__
+
+    def add_image(self, image_file, image_caption):
+        self.flush()
+        self.ops.append((self.IMAGE_OP, image_file))
+    # end add_image
+
+    def flush(self):
+        # One fragment per run of elements; parsing is cheaper in bulk
+        if len(self.body):
+            self.ops.append((self.XML_OP, etree.tostring(self.body)))
+            del self.body[:]
+    # end flush
+
+    def take_ops(self):
+        """ Return and forget the ops recorded so far """
+        self.flush()
+        ops = self.ops
+        self.ops = []
+        return ops
+    # end take_ops
+# FragmentRecorder
+
+
+class DebugRows(list):
+    """ Collects debug csv rows in a worker process, in place of a csv.writer """
+    writerow = list.append
+    writerows = list.extend
+# DebugRows
+
+
+class DebugSink():
+    """csv trace of every row and its resolved tokens, for settings.debug
+
+    Written to a file (or '-' for stdout) through a buffer of buffer_size
+    bytes.  Parsers take any object with writerow/writerows, or None to skip
+    the trace entirely."""
+
+    def __init__(self, target, buffer_size=2 ** 20):
+        self.target = target
+        if target == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(target, 'wb', buffer_size)
+        writer = csv.writer(self.file)
+        self.writerow = writer.writerow
+        self.writerows = writer.writerows
+    # end __init__
+
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+    # end close
+# DebugSink
+
+def debug_csv_file(output_file):
+    """ Default debug trace path for a conversion: out.docx -> out.debug.csv """
+    return os.path.splitext(output_file)[0] + '.debug.csv'
+# end debug_csv_file
+
+
+class FragmentCache():
+    """Rendered ops of each row id, kept between runs in cache_dir
+
+    A row's ops are reused while its hash is unchanged.  The hash covers the
+    clean row and its resolved token list, so a row is re-rendered when it
+    changes or when a heading it references through {#N}/{HN} changes.  Rows
+    that are no longer in the csv are dropped on close().  With a settings
+    profile, rows are also re-rendered when the parse settings change, and
+    with newline_mode when it does."""
+
+    VERSION = '1' # Bump when rendering changes, to invalidate old caches
+
+    def __init__(self, cache_dir, profile=None, newline_mode=None):
+        self.profile = profile
+        self.newline_mode = newline_mode
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'fragments.sqlite'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS fragments '
+                        '(id INTEGER PRIMARY KEY, hash TEXT, ops BLOB)')
+        self.seen_ids = set()
+        self.hits = 0
+        self.misses = 0
+    # end __init__
+
+    def row_hash(self, row_fields, replaced_list):
+        return hashlib.sha1(repr((self.VERSION, self.profile, self.newline_mode,
+                                  row_fields, replaced_list))).hexdigest()
+    # end row_hash
+
+    def get(self, row_id, row_hash):
+        """ Return the cached ops for row_id, or None if missing or stale """
+        self.seen_ids.add(row_id)
+        found = self.db.execute('SELECT hash, ops FROM fragments WHERE id = ?',
+                                (row_id,)).fetchone()
+        if found is None or found[0] != row_hash:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(found[1]))
+    # end get
+
+    def put(self, row_id, row_hash, ops):
+        self.db.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?)',
+                        (row_id, row_hash,
+                         buffer(cPickle.dumps(ops, cPickle.HIGHEST_PROTOCOL))))
+    # end put
+
+    def close(self):
+        self.db.execute('CREATE TEMP TABLE seen (id INTEGER PRIMARY KEY)')
+        self.db.executemany('INSERT INTO seen VALUES (?)',
+                            ((row_id,) for row_id in self.seen_ids))
+        self.db.execute('DELETE FROM fragments WHERE id NOT IN (SELECT id FROM seen)')
+        self.db.commit()
+        self.db.close()
+    # end close
+
+    def stats(self):
+        return {'fragment_cache_hits': self.hits,
+                'fragment_cache_misses': self.misses}
+    # end stats
+# FragmentCache
+
+
+class RowRecord(collections.namedtuple('RowRecord',
+                                         'id level heading_num heading_text body')):
+    """One clean input row, reduced to the five configured columns
+
+    id is the int row id and level the int heading level, or None for body
+    rows.  A tuple with no __dict__ costs a fraction of the full row list."""
+    __slots__ = ()
+
+    # Field positions, for lookup_xref
+    HEADING_NUM = 2
+    HEADING_TEXT = 3
+# RowRecord
+
+
+class Checkpoint():
+    """Progress of one conversion, saved every CHECKPOINT_ROWS rows for --resume
+
+    Each save adds the body elements appended since the previous save and
+    replaces the row count and the relationship and image state of the
+    DocxConfig, in one sqlite transaction, so an interrupted run always
+    leaves its last complete save behind."""
+
+    VERSION = '1' # Bump when the saved state changes
+
+    def __init__(self, folder, settings):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.filename = os.path.join(folder, 'checkpoint.sqlite')
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS fragments '
+                        '(seq INTEGER PRIMARY KEY, elements BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state '
+                        '(id INTEGER PRIMARY KEY, state BLOB)')
+        stat = os.stat(settings.INPUT_FILE)
+        # A checkpoint only resumes the same input, unchanged, to the same
+        # output, rendered the same way
+        self.identity = (self.VERSION, os.path.abspath(settings.INPUT_FILE),
+                         stat.st_size, stat.st_mtime,
+                         os.path.abspath(settings.OUTPUT_FILE),
+                         settings.profile, settings.newline_mode,
+                         ImagePreprocessor.params_from(settings))
+    # end __init__
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM fragments')
+            self.db.execute('DELETE FROM state')
+    # end clear
+
+    def restore(self, out_docx):
+        """ Load the saved progress into a new out_docx; returns the rows done """
+        found = self.db.execute('SELECT state FROM state').fetchone()
+        if found is None:
+            return 0
+        state = cPickle.loads(str(found[0]))
+        if state['identity'] != self.identity:
+            sys.exit("Checkpoint %s is for another input or output, or the input "
+                     "changed; run without --resume to start over\nExiting..." %
+                     self.filename)
+        out_docx.relationships = state['relationships']
+        out_docx.imagefiledict = state['imagefiledict']
+        cache = out_docx.image_cache
+        cache.digests = state['digests']
+        cache.paths = state['paths']
+        cache.pictures = dict((key, etree.fromstring(xml))
+                              for key, xml in state['pictures'].iteritems())
+        cache.hits, cache.misses = state['hits'], state['misses']
+        for elements, in self.db.execute('SELECT elements FROM fragments '
+                                         'ORDER BY seq'):
+            for xml in cPickle.loads(str(elements)):
+                out_docx.append(etree.fromstring(xml))
+        return state['rows_done']
+    # end restore
+
+    def save(self, rows_done, out_docx):
+        """ Save progress after rows_done rows, and empty out_docx.journal """
+        cache = out_docx.image_cache
+        state = {'identity': self.identity,
+                 'rows_done': rows_done,
+                 'relationships': out_docx.relationships,
+                 'imagefiledict': out_docx.imagefiledict,
+                 'digests': cache.digests,
+                 'paths': cache.paths,
+                 'pictures': dict((key, etree.tostring(picture))
+                                  for key, picture in cache.pictures.iteritems()),
+                 'hits': cache.hits,
+                 'misses': cache.misses}
+        elements = [etree.tostring(element) for element in out_docx.journal]
+        with self.db:
+            self.db.execute('INSERT INTO fragments VALUES (NULL, ?)',
+                            (buffer(cPickle.dumps(elements, cPickle.HIGHEST_PROTOCOL)),))
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (0, ?)',
+                            (buffer(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)),))
+        del out_docx.journal[:]
+    # end save
+
+    def remove(self):
+        """ Drop the checkpoint once the document is saved """
+        self.db.close()
+        os.remove(self.filename)
+    # end remove
+# Checkpoint
+
+
+_worker_parser = None
+
+def _init_render_worker(settings, xref):
+    global _worker_parser
+    _worker_parser = CsvParser(settings, xref=xref)
+    _worker_parser.out_docx = FragmentRecorder(settings)
+# end _init_render_worker
+
+def _render_chunk(args):
+    """ Clean, resolve and render a chunk of rows in a worker process """
+    rows, needs_clean, debug = args
+    parser = _worker_parser
+    debug_rows = DebugRows() if debug else None
+    for row in rows:
+        if needs_clean:
+            row = parser.clean_only(row)
+        parser.output_clean_row_to_docx(row, debug_rows)
+    return parser.out_docx.take_ops(), debug_rows
+# end _render_chunk
+
+def _render_section(args):
+    """ Render one --split section to its own docx in a worker process """
+    rows, output_file, stream_docx, deflate_threads = args
+    return _worker_parser.write_section(rows, output_file, stream_docx,
+                                        deflate_threads)
+# end _render_section
+
+def split_output_file(output_file, section_number):
+    """ out.docx -> out-01.docx, out-02.docx, ... for --split """
+    root, ext = os.path.splitext(output_file)
+    return '%s-%02d%s' % (root, section_number, ext)
+# end split_output_file
+
+
+class RowSource():
+    """Rows of the input file as lists of byte strings, header row first
+
+    Subclasses read other formats the way csv.reader reads a csv.  Only the
+    columns of the settings profile are read; the others are left as '' so
+    the column indexes in the settings keep working unchanged."""
 
     def __init__(self, settings):
+        self.s = settings
+        self.columns = settings.profile.columns
+        self.width = self.columns[-1] + 1
+    # end __init__
+
+    @staticmethod
+    def cell_text(value):
+        """ Text of a cell as the csv module would have read it """
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value)) # Spreadsheet ids and levels are floats
+        return str(value)
+    # end cell_text
+
+    def project(self, values):
+        """ Spread the values of self.columns out into a full width row """
+        row = [''] * self.width
+        for column, value in itertools.izip(self.columns, values):
+            row[column] = self.cell_text(value)
+        return row
+    # end project
+# RowSource
+
+
+class CsvRowSource(RowSource):
+    """Rows of a csv file, memory-mapped and split only as far as needed
+
+    A line without quoted fields is split on commas up to the last
+    configured column; the rest of the line is never split.  A record with
+    a quoted field, which may continue over the next lines, is parsed by
+    csv.reader, as is the whole file if it can't be mapped or
+    settings.csv_dialect is set.  As in excel csv, only a quote at the start
+    of a field opens a quoted field; any other quote is a literal."""
+
+    def csv_reader(self, lines):
+        dialect = self.s.csv_dialect
+        if isinstance(dialect, dict):
+            return csv.reader(lines, **dialect)
+        return csv.reader(lines, dialect or 'excel')
+    # end csv_reader
+
+    @staticmethod
+    def ends_in_quotes(line, in_quotes=False):
+        """ Whether a quoted field is still open at the end of line """
+        pos = 0
+        while True:
+            if in_quotes:
+                end = line.find('"', pos)
+                if end < 0:
+                    return True
+                if line.startswith('"', end + 1):
+                    pos = end + 2 # An escaped quote
+                    continue
+                in_quotes = False
+                pos = end + 1
+            elif line.startswith('"', pos): # At the start of a field
+                in_quotes = True
+                pos += 1
+                continue
+            comma = line.find(',', pos)
+            if comma < 0:
+                return False
+            pos = comma + 1
+    # end ends_in_quotes
+
+    def iter_mapped(self, buf):
+        width = self.width
+        readline = buf.readline
+        ends_in_quotes = self.ends_in_quotes
+        for line in iter(readline, ''):
+            if line.startswith('"') or ',"' in line:
+                # Read on to the end of the record, past quoted newlines
+                lines = [line]
+                in_quotes = ends_in_quotes(line)
+                while in_quotes:
+                    line = readline()
+                    if not line:
+                        break
+                    lines.append(line)
+                    in_quotes = ends_in_quotes(line, True)
+                for row in self.csv_reader(lines):
+                    yield row
+                continue
+            row = line.split(',', width)
+            if len(row) > width:
+                del row[width] # The unused columns, still joined
+            else:
+                row[-1] = row[-1].rstrip('\r\n')
+                if len(row) == 1 and not row[0]:
+                    row = [] # As csv.reader returns a blank line
+            yield row
+    # end iter_mapped
+
+    def __iter__(self):
+        with open(self.s.INPUT_FILE, 'rb') as csvfile:
+            buf = None
+            if self.s.csv_dialect is None:
+                try:
+                    buf = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    pass # Empty file, pipe...
+            if buf is None:
+                for row in self.csv_reader(csvfile):
+                    yield row
+                return
+            try:
+                for row in self.iter_mapped(buf):
+                    yield row
+            finally:
+                buf.close()
+    # end __iter__
+
+    def iter_spans(self):
+        """Yields (offset, length, row) for each record, for RowIndex
+
+        Always memory-maps the file, so offsets are exact; read_span parses
+        a record back from its span.  Exits if a record can't be given a
+        span of its own."""
+        with open(self.s.INPUT_FILE, 'rb') as csvfile:
+            buf = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                for row in self.iter_mapped(buf):
+                    end = buf.tell()
+                    if end == start:
+                        # One chunk of lines held several records
+                        sys.exit("Can't index %s: no offset of its own for the "
+                                 "record after byte %d\nExiting..." %
+                                 (self.s.INPUT_FILE, start))
+                    yield start, end - start, row
+                    start = end
+            finally:
+                buf.close()
+    # end iter_spans
+
+    def read_span(self, csvfile, offset, length):
+        """ Return the row of the record at offset in the open csvfile """
+        csvfile.seek(offset)
+        for row in self.iter_mapped(cStringIO.StringIO(csvfile.read(length))):
+            return row
+    # end read_span
+# CsvRowSource
+
+
+class XlsxRowSource(RowSource):
+    """ A worksheet read with openpyxl in read-only (streaming) mode """
+
+    def __iter__(self):
+        book = openpyxl.load_workbook(self.s.INPUT_FILE, read_only=True,
+                                      data_only=True)
+        try:
+            sheet = (book[self.s.input_sheet] if self.s.input_sheet
+                     else book.active)
+            for cells in sheet.iter_rows(max_col=self.width):
+                values = [cell.value for cell in cells]
+                values += [None] * (self.width - len(values))
+                yield self.project([values[i] for i in self.columns])
+        finally:
+            book.close()
+    # end __iter__
+# XlsxRowSource
+
+
+class SqliteRowSource(RowSource):
+    """ The result of input_query, column names first, like a csv header """
+
+    def __iter__(self):
+        connection = sqlite3.connect(self.s.INPUT_FILE)
+        try:
+            query = self.s.input_query
+            if not query:
+                table, = connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "ORDER BY rowid LIMIT 1").fetchone()
+                query = 'SELECT * FROM "%s"' % table
+            names = [column[0] for column in connection.execute(
+                'SELECT * FROM (%s) LIMIT 0' % query).description]
+            yield self.project([names[i] for i in self.columns])
+            # Let sqlite skip the unused columns rather than fetching them
+            projected = ', '.join('"%s"' % names[i].replace('"', '""')
+                                  for i in self.columns)
+            for values in connection.execute('SELECT %s FROM (%s)' %
+                                             (projected, query)):
+                yield self.project(values)
+        finally:
+            connection.close()
+    # end __iter__
+# SqliteRowSource
+
+
+class ArrowRowSource(RowSource):
+    """ Parquet or Arrow IPC files, read one row group/record batch at a time
+
+    Only the configured columns are decoded (parquet) or touched in the
+    memory map (arrow)."""
+
+    def is_ipc(self):
+        return get_input_format(self.s) == 'arrow'
+    # end is_ipc
+
+    def batches(self, names):
+        if self.is_ipc():
+            reader = ipc.open_file(pyarrow.memory_map(self.s.INPUT_FILE))
+            for i in xrange(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield [batch.column(batch.schema.get_field_index(name))
+                       for name in names]
+        else:
+            reader = parquet.ParquetFile(self.s.INPUT_FILE)
+            for i in xrange(reader.num_row_groups):
+                yield reader.read_row_group(i, columns=names).columns
+    # end batches
+
+    def schema_names(self):
+        if self.is_ipc():
+            return ipc.open_file(pyarrow.memory_map(self.s.INPUT_FILE)).schema.names
+        return parquet.ParquetFile(self.s.INPUT_FILE).schema.to_arrow_schema().names
+    # end schema_names
+
+    def __iter__(self):
+        all_names = self.schema_names()
+        names = [all_names[i] for i in self.columns]
+        yield self.project(names)
+        for columns in self.batches(names):
+            for values in itertools.izip(*[column.to_pylist()
+                                           for column in columns]):
+                yield self.project(values)
+    # end __iter__
+# ArrowRowSource
+
+# input_format (or input file extension) -> RowSource class
+ROW_SOURCES = {
+    'csv': CsvRowSource,
+    'xlsx': XlsxRowSource,
+    'xlsm': XlsxRowSource,
+    'sqlite': SqliteRowSource,
+    'db': SqliteRowSource,
+    'parquet': ArrowRowSource,
+    'arrow': ArrowRowSource,
+}
+
+def get_input_format(settings):
+    return (settings.input_format or
+            os.path.splitext(settings.INPUT_FILE)[1][1:].lower() or 'csv')
+# end get_input_format
+
+def open_row_source(settings):
+    """ RowSource for settings.INPUT_FILE, chosen by input_format/extension """
+    input_format = get_input_format(settings)
+    try:
+        row_source = ROW_SOURCES[input_format]
+    except KeyError:
+        sys.exit("Unknown input format '%s' for %s; expected one of %s\nExiting..." %
+                 (input_format, settings.INPUT_FILE, ', '.join(sorted(ROW_SOURCES))))
+    return row_source(settings)
+# end open_row_source
+
+
+class PipelineStage():
+    """One thread of CsvParser.write_docx_pipelined
+
+    Applies function (if any) to each item of source, in order, and queues
+    the results for whoever iterates the stage; at most PIPELINE_QUEUE_CHUNKS
+    run ahead.  An exception in the thread is re-raised in the consumer.
+    Once stop is set the stage finishes early, and drain() lets a consumer
+    that gave up release the stages before it."""
+
+    END = object()
+
+    def __init__(self, name, source, stop, function=None):
+        self.source = source
+        self.stop = stop
+        self.function = function
+        self.queue = Queue.Queue(PIPELINE_QUEUE_CHUNKS)
+        self.finished = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+    # end __init__
+
+    def run(self):
+        try:
+            for item in self.source:
+                if self.stop.is_set():
+                    break
+                if self.function is not None:
+                    item = self.function(item)
+                self.queue.put((None, item))
+        except Exception:
+            self.queue.put((sys.exc_info(), None))
+        finally:
+            if isinstance(self.source, PipelineStage):
+                self.source.drain()
+            self.queue.put((None, self.END))
+    # end run
+
+    def __iter__(self):
+        while not self.finished:
+            exc_info, item = self.queue.get()
+            if item is self.END:
+                self.finished = True
+            elif exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                yield item
+    # end __iter__
+
+    def drain(self):
+        """ Discard what is left, up to the end of the stage """
+        while not self.finished:
+            if self.queue.get()[1] is self.END:
+                self.finished = True
+    # end drain
+
+    def join(self):
+        self.thread.join()
+    # end join
+# PipelineStage
+
+
+class CsvParser():
+
+    def __init__(self, settings, streaming=False, xref=None):
         self.s = settings
         self.out_docx = None # Error if not set; TODO improve error handling
-        self.build_clean_dict()
+        self.streaming = streaming
+        self.clean_dict = None
+        self.xref_index = None
+        if xref is not None:
+            # Rows are handed over one by one, e.g. in a --jobs worker
+            self.known_ids, self.xref_index = xref
+        elif streaming:
+            self.build_xref_index()
+        else:
+            self.build_clean_dict()
     # end __init__
 
     def get_clean_dict(self):
@@ -257,7 +1765,7 @@ class CsvParser():
         try:
             self.out_docx.add_image(filename_or_other,
                                      'Captions not implemented - TBD')
-        except IOError as ex:
+        except EnvironmentError as ex: # IOError, or OSError from os.stat
             log.exception(str(ex))
         except Exception as ex:
             print "Assumed to be a block of text in delimeters" ,
@@ -269,63 +1777,79 @@ class CsvParser():
 
     # end insert_image
 
-    def parse_token(self, token):
+    def resolve_xref(self, symbol, digits, token_text=None):
+        """ Return the heading number or text a {#N}/{HN} token refers to """
         s = self.s
-        token_contents = token[len(s.l_delim):-len(s.r_delim)]
+        try:
+            if symbol == s.heading_text_symbol:
+                return self.lookup_xref(int(digits), RowRecord.HEADING_TEXT)
+            return self.lookup_xref(int(digits), RowRecord.HEADING_NUM)
+        except Exception as ex:
+            if token_text is None:
+                token_text = s.l_delim + symbol + digits + s.r_delim
+            utils.log("%s caught exception processing token, %s" %
+                      (inspect.stack()[0][3], token_text), ex=ex)
+            raise # Don't catch all without raising
+    # end resolve_xref
+
+    def resolve_note(self, contents):
         parsed = self.ParsedToken()
+        log.info('IMAGE OR NOTE: %s' % contents)
+        parsed.value = contents
+        parsed.is_image = True
+        return parsed
+    # end resolve_note
 
-        if re.match('^[#H]\d+$', token_contents):
+    def parse_token(self, token):
+        symbol, digits, contents = self.s.tokenizer.parse(token)
+        if symbol is None:
+            return self.resolve_note(contents)
+        parsed = self.ParsedToken()
+        parsed.value = self.resolve_xref(symbol, digits, token)
+        parsed.is_image = False
+        return parsed
+    # end parse_token
+
+    def lookup_xref(self, target_key, field):
+        """ Return RowRecord field of the clean row with id target_key """
+        if self.xref_index is None:
             try:
-                if (token_contents[0:len(s.heading_text_symbol)] ==
-                    s.heading_text_symbol):
-                    dict_index = s.heading_text_ind
-                elif (token_contents[0:len(s.heading_number_symbol)] ==
-                    s.heading_number_symbol):
-                    dict_index = s.heading_num_ind
-                else:
-                    print "OOPS: %s" % token_contents[0]
-                target_key = int(token_contents[1:])
-                if not self.clean_dict.has_key(target_key):
-                    print repr(self.clean_dict)
-                    raise CrossRefError('Did not find cross reference key, %d' % target_key)
-                target_dict = self.clean_dict[target_key]
-                parsed.value = target_dict[dict_index]
-                parsed.is_image = False
-                return parsed
-            except Exception as ex:
-                utils.log("%s caught exception processing token, %s" %
-                          (inspect.stack()[0][3], token), ex=ex)
-                raise # Don't catch all without raising
+                return self.clean_dict[target_key][field]
+            except KeyError:
+                print repr(self.clean_dict)
+                raise CrossRefError('Did not find cross reference key, %d' % target_key)
+
+        if target_key not in self.known_ids:
+            raise CrossRefError('Did not find cross reference key, %d' % target_key)
+        entry = self.xref_index.get(target_key)
+        if entry is None:
+            return ''
+        elif field == RowRecord.HEADING_NUM:
+            return entry[0]
         else:
-            log.info('IMAGE OR NOTE: %s' % token_contents)
-            parsed.value = token_contents
-            parsed.is_image = True
-            return parsed
-    # end parse_token
+            return entry[1]
+    # end lookup_xref
 
     def replace_tokens(self, body, row_id):
+        """Resolve cross references in body
+
+        Returns a list of text strings with a ParsedToken wherever an image
+        or note token interrupts the text."""
         result = []
         try:
-            s = self.s
-            esc_seq = '%s[^%s]*%s' % (s.l_delim, s.r_delim, s.r_delim)
-            non_matches = re.split(esc_seq, body)
-            matches = re.findall(esc_seq, body)
-            if len(non_matches) != len(matches) + 1:
-                raise LogicError('%s erred in regex logic' %
-                                 inspect.stack()[0][3])
-
-            this_str = ''
-            for i in range(0, len(matches)):
-                this_str += non_matches[i]
-                parsed = self.parse_token(matches[i])
-                if parsed.is_image:
-                    result.append(this_str)
-                    this_str = ''
-                    result.append(parsed)
+            stream = self.s.tokenizer.tokenize(body)
+            text_parts = []
+            for i in xrange(0, len(stream) - 1, Tokenizer.STRIDE):
+                text_parts.append(stream[i])
+                symbol = stream[i + 1]
+                if symbol is not None:
+                    text_parts.append(self.resolve_xref(symbol, stream[i + 2]))
                 else:
-                    this_str += parsed.value
-            result.append(this_str)
-            result.append(non_matches[-1])
+                    result.append(''.join(text_parts))
+                    text_parts = []
+                    result.append(self.resolve_note(stream[i + 3]))
+            result.append(''.join(text_parts))
+            result.append(stream[-1])
         except Exception as ex:
             print "Warning: did not write this data...\n%s" % str(row_id) + ": " + body
             raise # Don't catch all without raising
@@ -333,8 +1857,9 @@ class CsvParser():
         return result
     # end replace_tokens
 
-    def output_body_to_docx(self, body, row_id):
-        replaced_list = self.replace_tokens(body, row_id)
+    def output_body_to_docx(self, body, row_id, replaced_list=None):
+        if replaced_list is None:
+            replaced_list = self.replace_tokens(body, row_id)
         for entry in replaced_list:
             if isinstance(entry, CsvParser.ParsedToken):
                 self.insert_image(entry.value)
@@ -345,115 +1870,1065 @@ class CsvParser():
     # end output_body_to_docx
 
     def output_header_to_docx(self, row):
-        s = self.s
         try:
-            h_text = ' '.join((row[s.heading_num_ind],
-                               row[s.heading_text_ind]))
-            self.out_docx.write_heading(h_text,
-                                        int(row[s.heading_level_ind]))
+            h_text = ' '.join((row.heading_num, row.heading_text))
+            self.out_docx.write_heading(h_text, row.level)
         except (SystemError, SystemExit):
             raise
         except Exception as ex:
             print "Warning: did not write this heading...\n%s" % row
             raise # Don't catch all without raising
 
-    def write_debug_csv_data(self, row, debug_writer):
-        s = self.s
-        row_list = [row[ind] for ind in (s.id_ind,
-                                         s.heading_level_ind,
-                                         s.heading_num_ind,
-                                         s.heading_text_ind,
-                                         s.body_text_ind)]
-        replaced_body = repr(self.replace_tokens(
-                                row[s.body_text_ind], row[s.id_ind]))
-        row_list.append(replaced_body)
+    def write_debug_csv_data(self, row, debug_writer, replaced_list=None):
+        """Write row and the replace_tokens result already used to render it
+
+        Heading rows have no body to resolve, so replaced_list is None and
+        its column is left empty."""
+        row_list = list(row) # None level is written as ''
+        row_list.append('' if replaced_list is None else repr(replaced_list))
         debug_writer.writerow(row_list)
     # end write_debug_csv_data
 
     def output_row_to_docx(self, row_id, debug_writer=None):
-        s = self.s
-        row = self.clean_dict[row_id]
-        if len(row[s.heading_level_ind]):
+        self.output_clean_row_to_docx(self.clean_dict[row_id], debug_writer)
+    # end output_row_to_docx
+
+    def output_clean_row_to_docx(self, row, debug_writer=None, replaced_list=None):
+        if row.level is not None:
             self.output_header_to_docx(row)
         else:
-            self.output_body_to_docx(row[s.body_text_ind], row[s.id_ind])
-        if debug_writer:
-            self.write_debug_csv_data(row, debug_writer)
-    # end output_row_to_docx
+            # Resolved once and shared with the debug output
+            if replaced_list is None:
+                replaced_list = self.replace_tokens(row.body, row.id)
+            self.output_body_to_docx(row.body, row.id, replaced_list)
+        if debug_writer is not None:
+            self.write_debug_csv_data(row, debug_writer, replaced_list)
+    # end output_clean_row_to_docx
 
     def clean_only(self, row):
+        """ Return a RowRecord of the cleaned configured columns of row """
         s = self.s
-        new_row = row[:]
-        for i in s.all_inds:
-            new_row[i] = '\n'.join((DocxConfig.clean(line) for line in row[i].split('\n')))
-            # TODO: clean up previous line
-        return new_row
+        clean = DocxConfig.clean
+        level = row[s.heading_level_ind]
+        return RowRecord(int(row[s.id_ind]),
+                         int(level) if len(level) else None, # Parsed once
+                         clean(row[s.heading_num_ind]),
+                         clean(row[s.heading_text_ind]),
+                         clean(row[s.body_text_ind]))
     # clean_only
 
     def clean_n_parse_tokens(self, row, debug=False):
-        s = self.s
         new_row = self.clean_only(row)
-        for i in s.all_inds:
-            tmp = self.replace_tokens(new_row[i], new_row[s.id_ind])
+        for text in new_row[RowRecord.HEADING_NUM:]:
+            tmp = self.replace_tokens(text, new_row.id)
             # TODO: this is not finished
             # new_row[i] = DocxConfig.clean(row[i])
         return new_row
     # end clean_n_parse_tokens
 
+    # Reasons iter_csv_rows passes to skip_row
+    SHORT_ROW = 'short row'
+    NON_INT_ID = 'non-int id'
+    DUPLICATE_ID = 'duplicate id'
+
+    def skip_row(self, record_number, row, reason):
+        s = self.s
+        if reason == self.SHORT_ROW:
+            utils.log("row has fewer than %d entries\nRow: %s" %
+                       (s.id_ind + 1, row))
+        else:
+            utils.log('WARNING: Non-int or dupl key - ignoring extras: %s' %
+                      row[s.id_ind])
+            self.skipped_records.add(record_number)
+    # end skip_row
+
+    def iter_csv_rows(self, skip_records=None, rows=None, seen_ids=None):
+        """Yields (record_number, int_key, row) for each usable csv row
+
+        Rows with a non-int or duplicate id are passed to skip_row, which
+        logs them and adds them to self.skipped_records.  If skip_records is given, the
+        duplicates were found by an earlier pass, so those record numbers are
+        skipped instead of tracking every id seen.  rows are the raw rows to
+        check, by default all of open_row_source.  The ids yielded are added
+        to seen_ids, if given, so a caller can keep them without a copy."""
+        s = self.s
+        if seen_ids is None:
+            seen_ids = set()
+        self.skipped_records = set()
+        skipped_header = False
+        if rows is None:
+            rows = open_row_source(s)
+        for record_number, row in enumerate(rows):
+            if not len(''.join(row)) or (s.id_ind >= len(row)):
+                if skip_records is None:
+                    self.skip_row(record_number, row, self.SHORT_ROW)
+            elif skipped_header:
+                if skip_records is not None:
+                    if record_number not in skip_records:
+                        yield record_number, int(row[s.id_ind]), row
+                    continue
+                int_key = utils.int_repr(row[s.id_ind])
+                if int_key == None:
+                    self.skip_row(record_number, row, self.NON_INT_ID)
+                elif int_key in seen_ids:
+                    self.skip_row(record_number, row, self.DUPLICATE_ID)
+                else:
+                    seen_ids.add(int_key)
+                    yield record_number, int_key, row
+            else:
+                skipped_header = True
+    # end iter_csv_rows
+
     def build_clean_dict(self):
         """Builds a dictionary representation of input csv"""
-        s = self.s
         self.clean_dict = {}
         self.ordered_id_list = []
-        skipped_header = False
-        with open(s.INPUT_FILE, 'rb') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            for row in reader:
-                if not len(''.join(row)) or (s.id_ind >= len(row)):
-                    utils.log("row has fewer than %d entries\nRow: %s" %
-                               (s.id_ind + 1, row))
-                elif skipped_header:
-                    int_key = utils.int_repr(row[s.id_ind])
-                    if int_key == None or self.clean_dict.has_key(int_key):
-                        utils.log('WARNING: Non-int or dupl key - ignoring extras: %s' %
-                                  row[s.id_ind])
-                    else:
-                        self.ordered_id_list.append(int_key)
-                        self.clean_dict[int_key] = self.clean_only(row)
-                else:
-                    skipped_header = True
+        for record_number, int_key, row in self.iter_csv_rows():
+            self.ordered_id_list.append(int_key)
+            self.clean_dict[int_key] = self.clean_only(row)
     # end build_clean_dict
 
-    def write_docx(self, out_docx, debug=False):
-        self.out_docx = out_docx
-        with open('/tmp/debug.csv', 'wb') as debug_file:
-            debug_writer = csv.writer(debug_file)
+    def build_xref_index(self):
+        """First pass of streaming mode: index only what tokens can reference
+
+        Keeps the set of valid ids and, for rows with a heading number or
+        heading text, the cleaned (heading number, heading text) pair.  Body
+        text is dropped, so memory still grows with the row count (one id
+        per row, which duplicate and dangling reference checks share) but no
+        longer with the size of the rows."""
+        s = self.s
+        self.xref_index = {}
+        self.known_ids = set() # Filled by iter_csv_rows
+        self.ordered_id_list = None # Not kept in streaming mode
+        for record_number, int_key, row in self.iter_csv_rows(
+                seen_ids=self.known_ids):
+            heading_num = row[s.heading_num_ind]
+            heading_text = row[s.heading_text_ind]
+            if len(heading_num) or len(heading_text):
+                self.xref_index[int_key] = (DocxConfig.clean(heading_num),
+                                            DocxConfig.clean(heading_text))
+        self.skip_records = self.skipped_records
+    # end build_xref_index
+
+    def get_xref(self):
+        """ Return (known_ids, xref_index), building them from clean_dict if needed """
+        if self.xref_index is None:
+            known_ids = set(self.clean_dict)
+            xref_index = {}
+            for int_key, row in self.clean_dict.iteritems():
+                if len(row.heading_num) or len(row.heading_text):
+                    xref_index[int_key] = (row.heading_num, row.heading_text)
+            return known_ids, xref_index
+        return self.known_ids, self.xref_index
+    # end get_xref
+
+    def iter_clean_rows(self):
+        """ Yields clean rows in output order """
+        if not self.streaming:
             for row_id in self.ordered_id_list:
-                self.output_row_to_docx(row_id, debug_writer)
+                yield self.clean_dict[row_id]
+        else:
+            for record_number, int_key, row in self.iter_csv_rows(self.skip_records):
+                yield self.clean_only(row)
+    # end iter_clean_rows
+
+    def iter_row_chunks(self, chunk_rows):
+        """ Yields lists of rows in output order; raw rows in streaming mode """
+        if not self.streaming:
+            rows = (self.clean_dict[row_id] for row_id in self.ordered_id_list)
+        else:
+            rows = (row for record_number, int_key, row in
+                    self.iter_csv_rows(self.skip_records))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                return
+            yield chunk
+    # end iter_row_chunks
+
+    def apply_ops(self, ops):
+        """ Stitch ops from a FragmentRecorder into out_docx, in order """
+        for op in ops:
+            if op[0] == FragmentRecorder.XML_OP:
+                self.out_docx.append_xml(op[1])
+            else:
+                self.insert_image(op[1])
+    # end apply_ops
+
+    def write_docx_parallel(self, debug_writer, jobs):
+        """Render ordered chunks of rows in a pool of jobs processes
+
+        Workers resolve tokens against the shared cross-reference index and
+        return xml fragments; they are appended here in ordered_id_list
+        order, so the document matches the serial path exactly."""
+        pool = multiprocessing.Pool(jobs, _init_render_worker,
+                                    (self.s, self.get_xref()))
+        try:
+            chunks = self.iter_row_chunks(PARALLEL_CHUNK_ROWS)
+            while True:
+                # A bounded window keeps streaming mode from reading ahead
+                window = [(chunk, self.streaming, debug_writer is not None)
+                          for chunk in itertools.islice(chunks, jobs * 2)]
+                if not window:
+                    break
+                for ops, debug_rows in pool.imap(_render_chunk, window):
+                    self.apply_ops(ops)
+                    if debug_writer is not None:
+                        debug_writer.writerows(debug_rows)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    # end write_docx_parallel
+
+    def write_docx_cached(self, debug_writer, cache):
+        """ Render only rows whose hash changed since the last cached run """
+        s = self.s
+        out_docx = self.out_docx
+        recorder = FragmentRecorder(s)
+        try:
+            for row in self.iter_clean_rows():
+                replaced_list = None
+                if row.level is None:
+                    replaced_list = self.replace_tokens(row.body, row.id)
+                row_hash = cache.row_hash(row, replaced_list)
+                ops = cache.get(row.id, row_hash)
+                if ops is None:
+                    self.out_docx = recorder
+                    self.output_clean_row_to_docx(row, None, replaced_list)
+                    ops = recorder.take_ops()
+                    cache.put(row.id, row_hash, ops)
+                self.out_docx = out_docx
+                self.apply_ops(ops)
+                if debug_writer is not None:
+                    self.write_debug_csv_data(row, debug_writer, replaced_list)
+        finally:
+            self.out_docx = out_docx
+        cache.close()
+    # end write_docx_cached
+
+    def iter_sections(self, level):
+        """Yields lists of clean rows, cut before each heading of level or above
+
+        Rows ahead of the first such heading go with the first section."""
+        section = []
+        has_heading = False
+        for row in self.iter_clean_rows():
+            if row.level is not None and row.level <= level:
+                if has_heading:
+                    yield section
+                    section = []
+                has_heading = True
+            section.append(row)
+        if section:
+            yield section
+    # end iter_sections
+
+    def write_section(self, rows, output_file, stream_docx=False,
+                      deflate_threads=1):
+        """ Write rows to a docx of their own; returns its image cache stats """
+        if stream_docx:
+            self.out_docx = StreamingDocxConfig(self.s)
+        else:
+            self.out_docx = DocxConfig(self.s)
+        self.out_docx.deflate_threads = deflate_threads
+        try:
+            for row in rows:
+                self.output_clean_row_to_docx(row)
+        except:
+            if stream_docx:
+                self.out_docx.discard()
+            raise
+        self.out_docx.save(output_file)
+        return self.out_docx.image_cache.stats()
+    # end write_section
+
+    def write_docx_split(self, output_file, level, jobs=1, stream_docx=False,
+                         deflate_threads=1):
+        """Write each iter_sections section to split_output_file(output_file, n)
+
+        Sections are rendered concurrently with jobs processes.  Every
+        worker resolves tokens against the global cross-reference index, so
+        {#N}/{HN} work across files.  Returns the list of files written and
+        the summed image cache stats."""
+        sections = ((rows, split_output_file(output_file, number), stream_docx,
+                     deflate_threads)
+                    for number, rows in enumerate(self.iter_sections(level), 1))
+        results = []
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, _init_render_worker,
+                                        (self.s, self.get_xref()))
+            try:
+                while True:
+                    # A bounded window keeps streaming mode from reading ahead
+                    window = list(itertools.islice(sections, jobs * 2))
+                    if not window:
+                        break
+                    stats = pool.map(_render_section, window, chunksize=1)
+                    results.extend(zip([task[1] for task in window], stats))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for section in sections:
+                results.append((section[1], self.write_section(*section)))
+        totals = {'image_cache_hits': 0, 'image_cache_misses': 0}
+        for section_file, stats in results:
+            for key in totals:
+                totals[key] += stats[key]
+        return [section_file for section_file, stats in results], totals
+    # end write_docx_split
+
+    def referenced_ids(self, rows):
+        """ Return the set of ids the {#N}/{HN} tokens of rows refer to """
+        ids = set()
+        stride = Tokenizer.STRIDE
+        for row in rows:
+            if row.level is None:
+                stream = self.s.tokenizer.tokenize(row.body)
+                for symbol, digits in itertools.izip(stream[1::stride],
+                                                     stream[2::stride]):
+                    if symbol is not None:
+                        ids.add(int(digits))
+        return ids
+    # end referenced_ids
+
+    def prefetch_images(self, images):
+        """Hand every image file a body refers to to images.prefetch
+
+        Uses the clean rows when they are in memory; in streaming mode the
+        body column is read once more."""
+        s = self.s
+        if self.clean_dict is not None:
+            bodies = (row.body for row in self.clean_dict.itervalues())
+        else:
+            bodies = (DocxConfig.clean(row[s.body_text_ind])
+                      for row in open_row_source(s) if len(row) > s.body_text_ind)
+        for body in bodies:
+            for contents in s.tokenizer.tokenize(body)[3::Tokenizer.STRIDE]:
+                if contents is not None and os.path.isfile(contents):
+                    images.prefetch(contents)
+    # end prefetch_images
+
+    def resolve_rows(self, rows):
+        """Resolve stage of write_docx_pipelined: (row, replaced_list) pairs
+
+        The images a body refers to are hashed here, which also reads them
+        into the OS cache ahead of add_image."""
+        resolved = []
+        for row in rows:
+            replaced_list = None
+            if row.level is None:
+                replaced_list = self.replace_tokens(row.body, row.id)
+                for entry in replaced_list:
+                    if isinstance(entry, CsvParser.ParsedToken):
+                        try:
+                            self.out_docx.image_cache.digest(entry.value)
+                        except (IOError, OSError):
+                            pass # Not a readable image; insert_image reports it
+            resolved.append((row, replaced_list))
+        return resolved
+    # end resolve_rows
+
+    def write_docx_pipelined(self, debug_writer):
+        """Render rows while later rows are read and resolved on other threads
+
+        A reader thread runs iter_clean_rows (reading and cleaning the csv in
+        streaming mode) and a resolver thread runs resolve_rows; this thread
+        renders the rows in order as they arrive, PIPELINE_CHUNK_ROWS at a
+        time.  With a StreamingDocxConfig made with deflate_thread, a fourth
+        thread compresses the document as it is written."""
+        rows = self.iter_clean_rows()
+        chunks = iter(lambda: list(itertools.islice(rows, PIPELINE_CHUNK_ROWS)), [])
+        stop = threading.Event()
+        reader = PipelineStage('read', chunks, stop)
+        resolver = PipelineStage('resolve', reader, stop, self.resolve_rows)
+        try:
+            for chunk in resolver:
+                for row, replaced_list in chunk:
+                    self.output_clean_row_to_docx(row, debug_writer, replaced_list)
+        finally:
+            stop.set()
+            resolver.drain()
+            resolver.join()
+            reader.join()
+    # end write_docx_pipelined
+
+    def write_docx_checkpointed(self, debug_writer, checkpoint):
+        """Render rows serially, saving progress to checkpoint as it goes
+
+        Rows already saved in checkpoint are restored instead of rendered."""
+        out_docx = self.out_docx
+        rows_done = checkpoint.restore(out_docx)
+        out_docx.journal = []
+        try:
+            for row in itertools.islice(self.iter_clean_rows(), rows_done, None):
+                self.output_clean_row_to_docx(row, debug_writer)
+                rows_done += 1
+                if rows_done % CHECKPOINT_ROWS == 0:
+                    checkpoint.save(rows_done, out_docx)
+        finally:
+            out_docx.journal = None
+    # end write_docx_checkpointed
+
+    def write_docx(self, out_docx, debug_writer=None, jobs=1, cache=None,
+                   checkpoint=None, pipeline=False, debug=None):
+        """Render every row to out_docx
+
+        debug_writer (e.g. a DebugSink) gets a row per csv row with the
+        tokens resolved for it; with None no trace is built at all.  debug
+        is still accepted from older callers and ignored; convert's
+        debug_csv decides where the trace goes."""
+        self.out_docx = out_docx
+        if checkpoint is not None:
+            self.write_docx_checkpointed(debug_writer, checkpoint)
+        elif cache is not None:
+            self.write_docx_cached(debug_writer, cache)
+        elif jobs > 1:
+            self.write_docx_parallel(debug_writer, jobs)
+        elif pipeline:
+            self.write_docx_pipelined(debug_writer)
+        else:
+            for row in self.iter_clean_rows():
+                self.output_clean_row_to_docx(row, debug_writer)
     # end write_docx()
 
 # end CsvParser
 
-if __name__ == '__main__':
-    parser = create_parser()
-    args = parser.parse_args()
+class CsvChecker(CsvParser):
+    """Validate-only pass over the csv, without building a DocxConfig
 
-    s = MySettings()
-    s.read_json_file(args.settings) # Use argparse specified settings file
+    check() reads the csv once and returns a problem dict (record number,
+    row id, kind, detail) for every short row, non-int or duplicate id, bad
+    heading level, dangling {#N}/{HN} reference and missing image file."""
 
-    # Add the argparse inputs
-    s.INPUT_FILE = args.input
-    s.OUTPUT_FILE = args.output
+    BAD_HEADING_LEVEL = 'bad heading level'
+    DANGLING_REFERENCE = 'dangling reference'
+    MISSING_IMAGE = 'missing image'
+    MAX_HEADING_LEVEL = 9 # Heading1 to Heading9 styles
 
-    debug = hasattr(s, 'debug') and s.debug
+    def __init__(self, settings):
+        self.s = settings
+        self.streaming = False
+        self.clean_dict = None
+        self.xref_index = None
+        self.problems = []
+    # end __init__
 
+    def problem(self, record_number, row_id, kind, detail=''):
+        self.problems.append({'record': record_number, 'id': row_id,
+                              'kind': kind, 'detail': detail})
+    # end problem
 
-    out_docx = DocxConfig(s)
-    csv_parser = CsvParser(s)
+    def skip_row(self, record_number, row, reason):
+        s = self.s
+        row_id = row[s.id_ind] if s.id_ind < len(row) else ''
+        self.problem(record_number, row_id, reason)
+        self.skipped_records.add(record_number)
+    # end skip_row
 
-    csv_parser.write_docx(out_docx, debug=debug)
+    def check(self):
+        s = self.s
+        tokenizer = s.tokenizer
+        known_ids = set() # Filled by iter_csv_rows
+        references = []
+        image_exists = {}
+        for record_number, int_key, row in self.iter_csv_rows(seen_ids=known_ids):
+            level = row[s.heading_level_ind]
+            if len(level):
+                if not 1 <= (utils.int_repr(level) or 0) <= self.MAX_HEADING_LEVEL:
+                    self.problem(record_number, int_key, self.BAD_HEADING_LEVEL,
+                                 repr(level))
+                continue
+            stream = tokenizer.tokenize(row[s.body_text_ind])
+            for i in xrange(1, len(stream) - 1, Tokenizer.STRIDE):
+                symbol, digits, contents = stream[i:i + Tokenizer.STRIDE - 1]
+                if symbol is not None:
+                    references.append((record_number, int_key,
+                                       symbol, digits))
+                else:
+                    if contents not in image_exists:
+                        image_exists[contents] = os.path.isfile(contents)
+                    if not image_exists[contents]:
+                        self.problem(record_number, int_key, self.MISSING_IMAGE,
+                                     contents)
+        # References may point forward, so resolve them once all ids are known
+        for record_number, int_key, symbol, digits in references:
+            if int(digits) not in known_ids:
+                self.problem(record_number, int_key, self.DANGLING_REFERENCE,
+                             s.l_delim + symbol + digits + s.r_delim)
+        self.problems.sort(key=lambda problem: problem['record'])
+        return self.problems
+    # end check
+# end CsvChecker
+
+class RowIndex():
+    """Byte offset and heading of every usable csv row, in a sidecar file
+
+    The index is a sqlite file next to the csv (INPUT.idx), built on first
+    use and rebuilt when the csv's size or mtime or the settings columns
+    change.  It keeps each row's id, position in the file, offset and
+    length, and for headings the level, number and text, so an export of
+    some ids or one section (see export_rows) reads only those rows and the
+    headings they refer to."""
+
+    VERSION = '1' # Bump when the index changes
+
+    def __init__(self, settings, index_file=None):
+        s = settings
+        if get_input_format(s) != 'csv' or s.csv_dialect is not None:
+            sys.exit("A row index needs csv input without a csv_dialect\nExiting...")
+        self.s = settings
+        self.source = CsvRowSource(s)
+        self.index_file = index_file or s.INPUT_FILE + '.idx'
+        self.db = sqlite3.connect(self.index_file)
+        self.db.text_factory = str # Cleaned text is ascii bytes
+        stat = os.stat(s.INPUT_FILE)
+        self.identity = (self.VERSION, stat.st_size, stat.st_mtime, s.profile)
+        if not self.is_current():
+            self.build()
+    # end __init__
 
+    def is_current(self):
+        try:
+            found = self.db.execute('SELECT identity FROM meta').fetchone()
+        except sqlite3.OperationalError:
+            return False # No index yet
+        return found is not None and cPickle.loads(str(found[0])) == self.identity
+    # end is_current
+
+    def build(self):
+        """ Index every row iter_csv_rows accepts, in one transaction """
+        parser = CsvParser(self.s, xref=(set(), {})) # Reads nothing itself
+        span = [None]
+        def rows():
+            for offset, length, row in self.source.iter_spans():
+                span[0] = (offset, length)
+                yield row
+        def entries():
+            for seq, (record_number, int_key, row) in enumerate(
+                    parser.iter_csv_rows(rows=rows())):
+                record = parser.clean_only(row)
+                yield (int_key, seq, span[0][0], span[0][1], record.level,
+                       record.heading_num or None, record.heading_text or None)
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS meta')
+            self.db.execute('DROP TABLE IF EXISTS rows')
+            self.db.execute('CREATE TABLE rows (id INTEGER PRIMARY KEY, '
+                            'seq INTEGER UNIQUE, offset INTEGER, length INTEGER, '
+                            'level INTEGER, heading_num TEXT, heading_text TEXT)')
+            self.db.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                entries())
+            self.db.execute('CREATE TABLE meta (identity BLOB)')
+            self.db.execute('INSERT INTO meta VALUES (?)',
+                            (buffer(cPickle.dumps(self.identity,
+                                                  cPickle.HIGHEST_PROTOCOL)),))
+    # end build
+
+    def id_spans(self, id_ranges):
+        """ Return (offset, length) of the rows in (first, last) id_ranges, in order """
+        where = ' OR '.join(['id BETWEEN ? AND ?'] * len(id_ranges))
+        return self.db.execute('SELECT offset, length FROM rows WHERE %s '
+                               'ORDER BY seq' % where,
+                               list(itertools.chain(*id_ranges))).fetchall()
+    # end id_spans
+
+    def section_spans(self, number):
+        """Return (offset, length) of the heading numbered number and its rows
+
+        The section runs up to the next heading of the same level or above;
+        '3.2' and '3.2.' are the same number."""
+        number = number.rstrip('.')
+        for seq, level, heading_num in self.db.execute(
+                'SELECT seq, level, heading_num FROM rows '
+                'WHERE level IS NOT NULL ORDER BY seq'):
+            if heading_num is not None and heading_num.rstrip('.') == number:
+                break
+        else:
+            sys.exit("No heading numbered %s in %s\nExiting..." %
+                     (number, self.s.INPUT_FILE))
+        end = self.db.execute('SELECT MIN(seq) FROM rows WHERE seq > ? AND '
+                              'level IS NOT NULL AND level <= ?',
+                              (seq, level)).fetchone()[0]
+        if end is None:
+            end = self.db.execute('SELECT MAX(seq) + 1 FROM rows').fetchone()[0]
+        return self.db.execute('SELECT offset, length FROM rows WHERE seq >= ? '
+                               'AND seq < ? ORDER BY seq', (seq, end)).fetchall()
+    # end section_spans
+
+    def read_rows(self, spans):
+        """ Yields the raw row at each (offset, length) in spans """
+        with open(self.s.INPUT_FILE, 'rb') as csvfile:
+            for offset, length in spans:
+                yield self.source.read_span(csvfile, offset, length)
+    # end read_rows
+
+    def get_xref(self, ids):
+        """ Return (known_ids, xref_index), as CsvParser.get_xref, for ids only """
+        known_ids = set()
+        xref_index = {}
+        ids = sorted(ids)
+        for i in xrange(0, len(ids), 500): # Within sqlite's parameter limit
+            chunk = ids[i:i + 500]
+            for row_id, heading_num, heading_text in self.db.execute(
+                    'SELECT id, heading_num, heading_text FROM rows WHERE id IN '
+                    '(%s)' % ','.join('?' * len(chunk)), chunk):
+                known_ids.add(row_id)
+                if heading_num is not None or heading_text is not None:
+                    xref_index[row_id] = (heading_num or '', heading_text or '')
+        return known_ids, xref_index
+    # end get_xref
+
+    def close(self):
+        self.db.close()
+    # end close
+# RowIndex
+
+
+class StageProfiler():
+    """Counts, cumulative wall/cpu time and peak RSS per pipeline stage
+
+    install() wraps the methods listed in PROFILED_STAGES, so nothing is
+    timed (or slowed down) unless profiling is switched on.  Stage times are
+    inclusive: replace_tokens includes the resolve_xref calls it makes.  A
+    stage called from within itself (StreamingDocxConfig.save calling
+    DocxConfig.save) is only timed by the outer call.  Only the current
+    process is measured, not --jobs workers."""
+
+    def __init__(self):
+        self.stages = {}
+        self.originals = []
+        self.local = threading.local() # Stages running in each thread
+        self.start_wall = time.time()
+        self.start_cpu = time.clock()
+    # end __init__
+
+    def record(self, stage, wall, cpu, count=1):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {'calls': 0, 'wall_seconds': 0.0,
+                                          'cpu_seconds': 0.0, 'peak_rss_kb': 0}
+        entry['calls'] += count
+        entry['wall_seconds'] += wall
+        entry['cpu_seconds'] += cpu
+        entry['peak_rss_kb'] = max(entry['peak_rss_kb'], peak_rss_kb())
+    # end record
+
+    def timed(self, stage, function):
+        def timed_function(*args, **kwargs):
+            active = self.local.__dict__.setdefault('stages', set())
+            if stage in active:
+                return function(*args, **kwargs) # Already timed by the caller
+            active.add(stage)
+            wall, cpu = time.time(), time.clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.time() - wall, time.clock() - cpu)
+                active.discard(stage)
+        return timed_function
+    # end timed
+
+    def timed_generator(self, stage, function):
+        """ Time each item of a generator, counting items rather than calls """
+        def timed_function(*args, **kwargs):
+            items = function(*args, **kwargs)
+            while True:
+                wall, cpu = time.time(), time.clock()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    self.record(stage, time.time() - wall, time.clock() - cpu, 0)
+                    return
+                self.record(stage, time.time() - wall, time.clock() - cpu)
+                yield item
+        return timed_function
+    # end timed_generator
+
+    def install(self):
+        for owner, name, stage in PROFILED_STAGES:
+            original = owner.__dict__[name]
+            self.originals.append((owner, name, original))
+            if isinstance(original, staticmethod):
+                wrapped = staticmethod(self.timed(stage, original.__get__(owner)))
+            elif inspect.isgeneratorfunction(original):
+                wrapped = self.timed_generator(stage, original)
+            else:
+                wrapped = self.timed(stage, original)
+            setattr(owner, name, wrapped)
+    # end install
+
+    def uninstall(self):
+        while self.originals:
+            owner, name, original = self.originals.pop()
+            setattr(owner, name, original)
+    # end uninstall
+
+    def report(self):
+        report = {'stages': self.stages,
+                  'total_wall_seconds': time.time() - self.start_wall,
+                  'total_cpu_seconds': time.clock() - self.start_cpu,
+                  'peak_rss_kb': peak_rss_kb()}
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            report['tracemalloc_top'] = [
+                str(stat) for stat in snapshot.statistics('lineno')[:25]]
+        return report
+    # end report
+# StageProfiler
+
+def peak_rss_kb():
+    """ Peak resident set size of this process so far (KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# end peak_rss_kb
+
+PROFILED_STAGES = [
+    (CsvParser, 'iter_csv_rows', 'csv_read'),
+    (CsvParser, 'clean_only', 'clean_only'),
+    (CsvParser, 'replace_tokens', 'replace_tokens'),
+    (CsvParser, 'resolve_xref', 'resolve_xref'),
+    (CsvParser, 'parse_token', 'parse_token'),
+    (DocxConfig, 'write_heading', 'write_heading'),
+    (DocxConfig, 'write_paragraph', 'write_paragraph'),
+    (DocxConfig, 'add_image', 'add_image'),
+    (DocxConfig, 'save', 'save'),
+    (StreamingDocxConfig, 'save', 'save'),
+]
+
+
+_settings_cache = {}
+
+def load_settings(json_file):
+    """Return MySettings for json_file, parsed once per process
+
+    The cached instance is shared, so callers copy it before setting
+    INPUT_FILE/OUTPUT_FILE (as convert does).  A changed mtime re-parses."""
+    key = os.path.abspath(json_file)
+    mtime = os.path.getmtime(key)
+    cached = _settings_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        s = MySettings()
+        s.read_json_file(json_file)
+        cached = _settings_cache[key] = (mtime, s)
+    return cached[1]
+# end load_settings
+
+def convert(settings, input_file, output_file, streaming=False, jobs=1,
+            stream_docx=False, cache_dir=None, split_level=None, debug_csv=None,
+            checkpoint_dir=None, resume=False, pipeline=False, deflate_threads=1,
+            image_jobs=None):
+    """Convert one csv to one docx without modifying settings
+
+    With split_level, one docx per section is written instead; see
+    CsvParser.write_docx_split.  debug_csv is where the debug trace goes
+    ('-' for stdout, False for none); by default it is debug_csv_file
+    when the settings enable debug.  With checkpoint_dir, progress is saved
+    there as rows are rendered, and resume continues from the last save.
+    pipeline renders with CsvParser.write_docx_pipelined, streaming both
+    the input and the document.  deflate_threads compress word/document.xml
+    (unless pipeline already did, as it was written).  When the settings
+    preprocess images, image_jobs processes (default: one per cpu) start on
+    them before rendering."""
+    s = copy.copy(settings)
+    s.INPUT_FILE = input_file
+    s.OUTPUT_FILE = output_file
+    if checkpoint_dir and (jobs > 1 or cache_dir or split_level is not None):
+        sys.exit("Checkpoints need serial rendering, without --jobs, --cache-dir "
+                 "or --split\nExiting...")
+    if cache_dir and split_level is not None:
+        sys.exit("--cache-dir can't be combined with --split\nExiting...")
+    if pipeline and (jobs > 1 or cache_dir or checkpoint_dir or
+                     split_level is not None):
+        sys.exit("--pipeline can't be combined with --jobs, --cache-dir, "
+                 "--checkpoint or --split\nExiting...")
+    if pipeline:
+        streaming = stream_docx = True
+    if debug_csv is None and hasattr(s, 'debug') and s.debug:
+        debug_csv = debug_csv_file(output_file)
+
+    if split_level is not None:
+        csv_parser = CsvParser(s, streaming=streaming)
+        output_files, stats = csv_parser.write_docx_split(
+            output_file, split_level, jobs=jobs, stream_docx=stream_docx,
+            deflate_threads=deflate_threads)
+        stats['output_files'] = output_files
+        return stats
+
+    if stream_docx:
+        out_docx = StreamingDocxConfig(s, deflate_thread=pipeline)
+    else:
+        out_docx = DocxConfig(s)
+    out_docx.deflate_threads = deflate_threads
+    csv_parser = CsvParser(s, streaming=streaming)
+    cache = (FragmentCache(cache_dir, s.profile, s.newline_mode)
+             if cache_dir else None)
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = Checkpoint(checkpoint_dir, s)
+        if not resume:
+            checkpoint.clear()
+    debug_sink = DebugSink(debug_csv) if debug_csv else None
+    images = out_docx.images
+    try:
+        if images is not None:
+            images.start(image_jobs)
+            csv_parser.prefetch_images(images)
+        csv_parser.write_docx(out_docx, debug_writer=debug_sink, jobs=jobs,
+                              cache=cache, checkpoint=checkpoint,
+                              pipeline=pipeline)
+    except:
+        if stream_docx:
+            out_docx.discard()
+        raise
+    finally:
+        if debug_sink is not None:
+            debug_sink.close()
+        if images is not None:
+            images.close()
+    out_docx.save(s.OUTPUT_FILE)
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    stats = out_docx.image_cache.stats()
+    if cache is not None:
+        stats.update(cache.stats())
+    return stats
+# end convert
+
+def export_rows(settings, input_file, output_file, ids=None, section=None,
+                stream_docx=False, debug_csv=None, deflate_threads=1):
+    """Convert only some rows of a csv, read through its RowIndex
+
+    ids is a list of (first, last) id ranges and section a heading number;
+    the section runs to the next heading of its level or above.  Only the
+    selected rows are read, and cross-references are resolved from the
+    index, so the cost tracks the size of the export, not of the csv.
+    Rows are written in file order; debug_csv and deflate_threads are as
+    for convert."""
+    s = copy.copy(settings)
+    s.INPUT_FILE = input_file
+    s.OUTPUT_FILE = output_file
+    if debug_csv is None and hasattr(s, 'debug') and s.debug:
+        debug_csv = debug_csv_file(output_file)
+
+    index = RowIndex(s)
+    try:
+        spans = []
+        if ids:
+            spans.extend(index.id_spans(ids))
+        if section is not None:
+            spans.extend(index.section_spans(section))
+        spans = sorted(set(spans)) # File order, once each
+        csv_parser = CsvParser(s, xref=(set(), {}))
+        rows = [csv_parser.clean_only(row) for row in index.read_rows(spans)]
+        csv_parser.known_ids, csv_parser.xref_index = index.get_xref(
+            csv_parser.referenced_ids(rows) | set(row.id for row in rows))
+    finally:
+        index.close()
+
+    if stream_docx:
+        out_docx = StreamingDocxConfig(s)
+    else:
+        out_docx = DocxConfig(s)
+    out_docx.deflate_threads = deflate_threads
+    csv_parser.out_docx = out_docx
+    debug_sink = DebugSink(debug_csv) if debug_csv else None
+    try:
+        for row in rows:
+            csv_parser.output_clean_row_to_docx(row, debug_sink)
+    except:
+        if stream_docx:
+            out_docx.discard()
+        raise
+    finally:
+        if debug_sink is not None:
+            debug_sink.close()
     out_docx.save(s.OUTPUT_FILE)
+
+    stats = out_docx.image_cache.stats()
+    stats['rows'] = len(rows)
+    return stats
+# end export_rows
+
+def read_manifest(manifest_file, default_settings=DEFAULT_JSON):
+    """Return a list of {input, output, settings} dicts from a batch manifest
+
+    The manifest is either a json list of objects or a csv with a header row,
+    each with input, output and (optionally) settings.  Relative paths are
+    relative to the manifest's folder; default_settings is used as given."""
+    folder = os.path.dirname(os.path.abspath(manifest_file))
+    try:
+        if manifest_file.lower().endswith('.json'):
+            with open(manifest_file) as f:
+                entries = json.load(f)
+        else:
+            with open(manifest_file, 'rb') as f:
+                entries = list(csv.DictReader(f))
+    except (IOError, ValueError) as ex:
+        sys.exit("Failed to read batch manifest %s (%s)\nExiting..." %
+                 (manifest_file, ex))
+
+    conversions = []
+    for entry in entries:
+        conversion = {'settings': os.path.abspath(default_settings)}
+        for key in ('input', 'output', 'settings'):
+            if entry.get(key):
+                conversion[key] = os.path.join(folder, entry[key])
+            elif key != 'settings':
+                sys.exit("Manifest entry is missing '%s': %s\nExiting..." %
+                         (key, entry))
+        conversions.append(conversion)
+    return conversions
+# end read_manifest
+
+def _convert_entry(args):
+    """ Run one manifest entry and return its summary record """
+    conversion, options = args
+    record = dict(conversion)
+    start = time.time()
+    try:
+        record.update(convert(load_settings(conversion['settings']),
+                              conversion['input'], conversion['output'],
+                              **options))
+        record['status'] = 'ok'
+    except (Exception, SystemExit) as ex:
+        # MySettings and friends sys.exit on bad input; keep going
+        log.exception('Batch conversion failed: %s' % conversion['input'])
+        record['status'] = 'failed'
+        record['error'] = '%s: %s' % (type(ex).__name__, ex)
+    record['seconds'] = time.time() - start
+    return record
+# end _convert_entry
+
+def run_batch(conversions, jobs=1, **options):
+    """Convert every entry from read_manifest in this process (or a pool)
+
+    options are passed on to convert.  Returns a summary dict with a record
+    per conversion, in manifest order."""
+    start = time.time()
+    tasks = [(conversion, options) for conversion in conversions]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            records = pool.map(_convert_entry, tasks, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        records = [_convert_entry(task) for task in tasks]
+    return {'total': len(records),
+            'failed': len([r for r in records if r['status'] != 'ok']),
+            'seconds': time.time() - start,
+            'conversions': records}
+# end run_batch
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if (args.ids or args.section is not None) and (
+            args.split is not None or args.jobs > 1 or args.pipeline or
+            args.cache_dir or args.checkpoint):
+        parser.error("--ids and --section can't be combined with --split, "
+                     "--jobs, --pipeline, --cache-dir or --checkpoint")
+    logging.basicConfig(format=FORMAT,
+                        filename=os.path.join(THIS_FOLDER, 'temp.log'))
+
+    if not args.profile:
+        return run(args)
+
+    profiler = StageProfiler()
+    profiler.install()
+    cprofile = None
+    if args.profile_dump:
+        cprofile = cProfile.Profile()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        cprofile.enable()
+    try:
+        return run(args)
+    finally:
+        profiler.uninstall()
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(args.profile_dump)
+        with open(args.profile, 'w') as report_file:
+            json.dump(profiler.report(), report_file, indent=2, sort_keys=True)
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+# end main
+
+def run(args):
+    if args.serve:
+        import csv2docx_server # Only the service needs the http modules
+        return csv2docx_server.serve(args.serve, args.settings, jobs=args.jobs)
+
+    if args.check:
+        s = MySettings()
+        s.read_json_file(args.settings)
+        s.INPUT_FILE = args.input
+        problems = CsvChecker(s).check()
+        for problem in problems:
+            print 'record %(record)d (id %(id)s): %(kind)s %(detail)s' % problem
+        print '%d problem(s) found in %s' % (len(problems), args.input)
+        return 1 if problems else 0
+
+    if args.batch:
+        summary = run_batch(read_manifest(args.batch, args.settings),
+                            jobs=args.jobs, streaming=args.stream,
+                            stream_docx=args.stream_docx,
+                            split_level=args.split, pipeline=args.pipeline,
+                            deflate_threads=args.deflate_threads,
+                            debug_csv=None if args.debug_csv_enabled else False)
+        summary_json = json.dumps(summary, indent=2, sort_keys=True)
+        if args.summary:
+            with open(args.summary, 'w') as summary_file:
+                summary_file.write(summary_json)
+        else:
+            print summary_json
+        print 'Done: %d of %d failed' % (summary['failed'], summary['total'])
+        return 1 if summary['failed'] else 0
+
+    s = MySettings()
+    s.read_json_file(args.settings) # Use argparse specified settings file
+
+    if args.ids or args.section is not None:
+        stats = export_rows(s, args.input, args.output, ids=args.ids,
+                            section=args.section, stream_docx=args.stream_docx,
+                            debug_csv=args.debug_csv if args.debug_csv_enabled else False,
+                            deflate_threads=args.deflate_threads)
+        print 'Exported %d rows' % stats['rows']
+        print 'Done :-)'
+        return 0
+
+    stats = convert(s, args.input, args.output, streaming=args.stream,
+                    jobs=args.jobs, stream_docx=args.stream_docx,
+                    cache_dir=args.cache_dir, split_level=args.split,
+                    debug_csv=args.debug_csv if args.debug_csv_enabled else False,
+                    checkpoint_dir=args.checkpoint, resume=args.resume,
+                    pipeline=args.pipeline, deflate_threads=args.deflate_threads,
+                    image_jobs=args.image_jobs)
+    if args.split is not None:
+        print 'Wrote %d documents: %s' % (len(stats['output_files']),
+                                          ', '.join(stats['output_files']))
+    print 'Image cache: %(image_cache_hits)d hits, %(image_cache_misses)d misses' % stats
+    if args.cache_dir:
+        print ('Fragment cache: %(fragment_cache_hits)d reused, '
+               '%(fragment_cache_misses)d rendered' % stats)
     print 'Done :-)'
+    return 0
+# end run
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 # end __main__
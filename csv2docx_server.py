@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+
+"""
+Long-running conversion service for csv2docx (csv2docx.py --serve).
+
+POST a csv to /convert and the docx comes back in the response:
+
+    curl --data-binary @test/input.csv -o output.docx \\
+         'http://127.0.0.1:8000/convert?settings=test_settings'
+
+settings names a json file in the folder of --settings (without .json) and
+defaults to --settings itself.  Conversions run in a pool of --jobs worker
+processes that keep the parsed settings, the docx template and the imported
+docx/lxml modules warm between requests.  GET /health reports the counts.
+
+Only meant to listen on localhost, for a trusted local client.
+"""
+
+import os
+import sys
+import json
+import signal
+import shutil
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+
+import csv2docx
+
+DOCX_CONTENT_TYPE = ('application/vnd.openxmlformats-officedocument.'
+                     'wordprocessingml.document')
+COPY_BUFFER = 2 ** 16
+PENDING_PER_JOB = 4 # Conversions queued per worker before answering 503
+
+
+def _init_server_worker(settings_files):
+    """ Warm up a worker: settings profiles, docx/lxml and the template """
+    # Ctrl-C reaches the whole process group; let serve() shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for settings_file in settings_files:
+        csv2docx.load_settings(settings_file)
+    csv2docx.template_parts()
+# end _init_server_worker
+
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server handing conversions to a bounded process pool
+
+    Each request thread spools its upload to a temporary folder, waits for
+    a pool worker to convert it and streams the docx back.  At most
+    jobs * PENDING_PER_JOB conversions are accepted at a time; more get a
+    503 rather than piling up."""
+
+    daemon_threads = True
+
+    def __init__(self, address, settings_file, jobs=1):
+        self.pool = None # server_close runs if binding the address fails
+        BaseHTTPServer.HTTPServer.__init__(self, address, ConversionHandler)
+        self.settings_file = os.path.abspath(settings_file)
+        self.settings_folder = os.path.dirname(self.settings_file)
+        self.pool = multiprocessing.Pool(jobs, _init_server_worker,
+                                         ([self.settings_file],))
+        self.slots = threading.BoundedSemaphore(jobs * PENDING_PER_JOB)
+        self.counts_lock = threading.Lock()
+        self.counts = {'ok': 0, 'failed': 0, 'busy': 0}
+    # end __init__
+
+    def profile_file(self, name):
+        """ Settings file for a ?settings= profile name, or None if unknown """
+        if not name:
+            return self.settings_file
+        settings_file = os.path.join(self.settings_folder,
+                                     os.path.basename(name) + '.json')
+        if os.path.isfile(settings_file):
+            return settings_file
+        return None
+    # end profile_file
+
+    def count(self, status):
+        with self.counts_lock:
+            self.counts[status] += 1
+    # end count
+
+    def convert(self, settings_file, input_file, output_file):
+        """ Run csv2docx.convert in the pool; returns its summary record """
+        conversion = {'settings': settings_file, 'input': input_file,
+                      'output': output_file}
+        options = {'stream_docx': True, 'debug_csv': False}
+        return self.pool.apply(csv2docx._convert_entry, ((conversion, options),))
+    # end convert
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+    # end server_close
+# ConversionServer
+
+
+class ConversionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def send_text(self, code, text, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+    # end send_text
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != '/health':
+            return self.send_text(404, 'Not found\n')
+        with self.server.counts_lock:
+            counts = dict(self.server.counts)
+        self.send_text(200, json.dumps(counts), 'application/json')
+    # end do_GET
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/convert':
+            return self.send_text(404, 'Not found\n')
+        query = urlparse.parse_qs(url.query)
+        settings_file = self.server.profile_file(query.get('settings', [''])[0])
+        if settings_file is None:
+            return self.send_text(400, 'Unknown settings profile\n')
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+        except (TypeError, ValueError):
+            return self.send_text(411, 'Content-Length required\n')
+
+        if not self.server.slots.acquire(False):
+            self.server.count('busy')
+            return self.send_text(503, 'Busy, try again later\n')
+        folder = tempfile.mkdtemp(prefix='csv2docx-')
+        try:
+            input_file = os.path.join(folder, 'input.csv')
+            output_file = os.path.join(folder, 'output.docx')
+            with open(input_file, 'wb') as f:
+                while length > 0:
+                    data = self.rfile.read(min(length, COPY_BUFFER))
+                    if not data:
+                        break
+                    f.write(data)
+                    length -= len(data)
+            record = self.server.convert(settings_file, input_file, output_file)
+            if record['status'] != 'ok':
+                self.server.count('failed')
+                return self.send_text(400, record['error'] + '\n')
+
+            self.server.count('ok')
+            self.send_response(200)
+            self.send_header('Content-Type', DOCX_CONTENT_TYPE)
+            self.send_header('Content-Length', str(os.path.getsize(output_file)))
+            self.end_headers()
+            with open(output_file, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, COPY_BUFFER)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            self.server.slots.release()
+    # end do_POST
+
+    def log_message(self, format, *args):
+        csv2docx.log.info('%s %s' % (self.address_string(), format % args))
+    # end log_message
+# ConversionHandler
+
+
+def serve(address, settings_file, jobs=1):
+    """ Serve conversions on address ('host:port' or 'port') until interrupted """
+    host, _, port = address.rpartition(':')
+    server = ConversionServer((host or '127.0.0.1', int(port)), settings_file,
+                              jobs=jobs)
+    print 'Serving on http://%s:%d/convert' % server.server_address
+    sys.stdout.flush()
+    # Stop as cleanly on a service manager's SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+# end serve
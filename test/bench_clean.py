@@ -0,0 +1,40 @@
+"""
+Benchmark for DocxConfig.clean on MB-sized bodies: the per-character
+curses.ascii generator it used to be vs the translate table.
+
+Usage: python test/bench_clean.py [megabytes]
+"""
+
+import os
+import random
+import sys
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+from csv2docx import DocxConfig
+from test_docxconfig import legacy_clean, random_text
+
+
+def megabytes_per_second(clean, text):
+    start = time.time()
+    clean(text)
+    return len(text) / (time.time() - start) / 2 ** 20
+
+
+def main(megabytes=4):
+    rng = random.Random(0)
+    chunk = random_text(rng, 2 ** 16, 0xFF)
+    text = chunk * int(megabytes * 2 ** 4)
+    utext = random_text(rng, 2 ** 16, 0xFFFF) * int(megabytes * 2 ** 4)
+
+    for label, body in (('str', text), ('unicode', utext)):
+        legacy = megabytes_per_second(legacy_clean, body)
+        current = megabytes_per_second(DocxConfig.clean, body)
+        print '%-8s %5.1f MB  legacy: %8.2f MB/s  table: %8.2f MB/s (%.0fx)' % (
+            label, megabytes, legacy, current, current / legacy)
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]])
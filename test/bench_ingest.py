@@ -0,0 +1,51 @@
+"""
+Benchmark for reading csv rows: csv.reader over every column (as
+CsvRowSource did, and still does with csv_dialect set) vs the memory-mapped
+path that splits only up to the configured columns.
+
+Usage: python test/bench_ingest.py [num_rows] [extra_columns]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+from csv2docx import CsvParser, CsvRowSource, MySettings
+from synthetic import write_synthetic_csv
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+
+
+def seconds(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def main(num_rows=100000, extra_columns=60):
+    s = MySettings()
+    s.read_json_file(JSON_FILE)
+    handle, s.INPUT_FILE = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        write_synthetic_csv(s.INPUT_FILE, num_rows, unicode_mix=0.05,
+                            extra_columns=extra_columns)
+        megabytes = os.path.getsize(s.INPUT_FILE) / 2.0 ** 20
+        print '%d rows, %d columns, %.0f MB' % (num_rows, 6 + extra_columns,
+                                               megabytes)
+        for label, dialect in (('csv.reader', 'excel'), ('mapped', None)):
+            s.csv_dialect = dialect
+            rows = seconds(lambda: sum(1 for row in CsvRowSource(s)))
+            parse = seconds(lambda: CsvParser(s))
+            print '%-10s rows: %5.2fs (%6.1f MB/s)  CsvParser: %5.2fs' % (
+                label, rows, megabytes / rows, parse)
+    finally:
+        os.remove(s.INPUT_FILE)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,59 @@
+"""
+Benchmark for DocxConfig.write_paragraph on bodies with many lines:
+docx.paragraph per line (as it used to be) vs ParagraphBuilder, in both
+newline modes.
+
+Usage: python test/bench_paragraphs.py [lines_per_body] [bodies]
+"""
+
+import os
+import random
+import sys
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+import docx
+from csv2docx import DocxConfig, MySettings
+from synthetic import WORDS
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+
+
+class LegacyDocxConfig(DocxConfig):
+
+    def write_paragraph(self, para, row_id):
+        if len(para):
+            for para_text in para.split('\n'):
+                self.append(docx.paragraph(para_text))
+
+
+def lines_per_second(docx_class, settings, bodies):
+    out_docx = docx_class(settings)
+    start = time.time()
+    for row_id, body in enumerate(bodies):
+        out_docx.write_paragraph(body, row_id)
+    return sum(body.count('\n') + 1 for body in bodies) / (time.time() - start)
+
+
+def main(lines_per_body=300, num_bodies=100):
+    s = MySettings()
+    s.read_json_file(JSON_FILE)
+    rng = random.Random(0)
+    bodies = ['\n'.join(' '.join(rng.choice(WORDS) for i in xrange(8))
+                        for line in xrange(lines_per_body))
+              for body in xrange(num_bodies)]
+
+    legacy = lines_per_second(LegacyDocxConfig, s, bodies)
+    print '%d bodies of %d lines' % (num_bodies, lines_per_body)
+    print 'docx.paragraph:      %9.0f lines/s' % legacy
+    for mode in ('paragraph', 'break'):
+        s.newline_mode = mode
+        current = lines_per_second(DocxConfig, s, bodies)
+        print 'builder, %-10s %9.0f lines/s (%.1fx)' % (mode + ':', current,
+                                                        current / legacy)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,82 @@
+"""
+Benchmark for the memory held by CsvParser.clean_dict: the full cleaned
+row list copies it used to keep vs the RowRecord of the five configured
+columns, on a wide synthetic csv.
+
+Usage: python test/bench_rows.py [num_rows] [extra_columns]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+from csv2docx import CsvParser, MySettings, DocxConfig
+from synthetic import write_synthetic_csv
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+
+
+def legacy_clean_only(parser, row):
+    new_row = row[:]
+    for i in parser.s.all_inds:
+        new_row[i] = DocxConfig.clean(row[i])
+    return new_row
+
+
+def legacy_build_clean_dict(parser):
+    parser.clean_dict = {}
+    for record_number, int_key, row in parser.iter_csv_rows():
+        parser.clean_dict[int_key] = legacy_clean_only(parser, row)
+
+
+def deep_size(clean_dict):
+    """ Bytes held by the rows of clean_dict, counting shared objects once """
+    seen = set()
+    total = 0
+    for row in clean_dict.itervalues():
+        for obj in [row] + list(row):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def main(num_rows=100000, extra_columns=60):
+    s = MySettings()
+    s.read_json_file(JSON_FILE)
+    handle, s.INPUT_FILE = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        write_synthetic_csv(s.INPUT_FILE, num_rows, extra_columns=extra_columns)
+
+        start = time.time()
+        parser = CsvParser(s)
+        current_seconds = time.time() - start
+        current = deep_size(parser.clean_dict)
+
+        # The mapped reader stops at the configured columns; csv.reader
+        # reads every column, as the legacy rows kept them
+        s.csv_dialect = 'excel'
+        start = time.time()
+        legacy_build_clean_dict(parser)
+        legacy_seconds = time.time() - start
+        legacy = deep_size(parser.clean_dict)
+    finally:
+        os.remove(s.INPUT_FILE)
+
+    per_100k = 100000.0 / num_rows / 2 ** 20
+    print '%d rows, %d columns' % (num_rows, 6 + extra_columns)
+    print 'legacy rows: %8.1f MB per 100k rows, built in %.2fs' % (
+        legacy * per_100k, legacy_seconds)
+    print 'RowRecord:   %8.1f MB per 100k rows, built in %.2fs' % (
+        current * per_100k, current_seconds)
+    print 'saved:       %8.1f MB per 100k rows (%.0fx smaller)' % (
+        (legacy - current) * per_100k, float(legacy) / current)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,110 @@
+"""
+Benchmark for DocxConfig.save on an image-heavy document: the test/images
+smileys scaled up and saved as distinct png and jpeg files, saved with
+docx.savedocx (as it used to be) and with the deflate_levels,
+store_compressed_media and deflate_threads options.
+
+Usage: python test/bench_save.py [images] [paragraphs] [scale]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+import docx
+from PIL import Image
+from csv2docx import DocxConfig, MySettings
+from synthetic import WORDS
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+SMILEYS = ['240px-Smiley.svg.png', '480px-Smiley.svg.png', '600px-Smiley.svg.png']
+
+OPTIONS = [
+    ('deflate everything',  dict(store_compressed_media=False)),
+    ('store media',         dict()),
+    ('store media, level 1', dict(deflate_levels={'document': 1, 'xml': 1})),
+    ('store media, 4 threads', dict(deflate_threads=4)),
+    ('store everything',    dict(deflate_levels={'document': 0, 'xml': 0})),
+]
+
+
+class LegacyDocxConfig(DocxConfig):
+
+    def save(self, out_file):
+        (coreprops, appprops, content_types, web_settings,
+         word_relationships) = [tree for tree, name in self.support_parts()]
+        docx.savedocx(self.document, coreprops, appprops, content_types,
+                      web_settings, word_relationships, out_file,
+                      imagefiledict=self.imagefiledict)
+
+
+def scaled_images(folder, num_images, scale):
+    """ Distinct scaled-up smileys, alternately png and jpeg """
+    image_files = []
+    for i in xrange(num_images):
+        image = Image.open(os.path.join(THIS_FOLDER, 'images',
+                                        SMILEYS[i % len(SMILEYS)]))
+        image = image.convert('RGB').resize((image.size[0] * scale,
+                                             image.size[1] * scale))
+        image.putpixel((i, 0), (i % 256, 0, 0)) # Distinct content
+        ext = '.png' if i % 2 == 0 else '.jpg'
+        image_file = os.path.join(folder, 'smiley%03d%s' % (i, ext))
+        image.save(image_file)
+        image_files.append(image_file)
+    return image_files
+
+
+def build(docx_class, settings, image_files, bodies):
+    out_docx = docx_class(settings)
+    for row_id, body in enumerate(bodies):
+        out_docx.write_paragraph(body, row_id)
+        if row_id % (len(bodies) // len(image_files) or 1) == 0 and image_files:
+            out_docx.add_image(image_files[row_id % len(image_files)], 'caption')
+    return out_docx
+
+
+def time_save(out_docx, out_file):
+    start = time.time()
+    out_docx.save(out_file)
+    return time.time() - start, os.path.getsize(out_file)
+
+
+def main(num_images=40, num_paragraphs=50000, scale=4):
+    folder = tempfile.mkdtemp()
+    try:
+        image_files = scaled_images(folder, num_images, scale)
+        rng = random.Random(0)
+        bodies = [' '.join(rng.choice(WORDS) for i in xrange(20))
+                  for row_id in xrange(num_paragraphs)]
+        out_file = os.path.join(folder, 'out.docx')
+        print '%d images (%.1f MB), %d paragraphs' % (
+            num_images, sum(os.path.getsize(f) for f in image_files) / 1e6,
+            num_paragraphs)
+
+        s = MySettings()
+        s.read_json_file(JSON_FILE)
+        seconds, size = time_save(build(LegacyDocxConfig, s, image_files, bodies),
+                                  out_file)
+        print '%-24s %6.2f s %8.2f MB' % ('docx.savedocx:', seconds, size / 1e6)
+        legacy = seconds
+        for name, options in OPTIONS:
+            s = MySettings()
+            s.read_json_file(JSON_FILE)
+            out_docx = build(DocxConfig, s, image_files, bodies)
+            for key, value in options.items():
+                setattr(out_docx if key == 'deflate_threads' else s, key, value)
+            seconds, size = time_save(out_docx, out_file)
+            print '%-24s %6.2f s %8.2f MB (%.1fx)' % (name + ':', seconds,
+                                                      size / 1e6, legacy / seconds)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
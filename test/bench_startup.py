@@ -0,0 +1,51 @@
+"""
+Startup-time benchmark: wall time of fresh interpreters running the light
+csv2docx entry paths, and whether they imported docx/lxml.
+
+Usage: python test/bench_startup.py [runs]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+ROOT_FOLDER = os.path.dirname(THIS_FOLDER)
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+
+HEAVY_CHECK = ("import sys; heavy = [m for m in ('docx', 'lxml', 'PIL') "
+               "if m in sys.modules]; sys.stderr.write(repr(heavy))")
+COMMANDS = [
+    ('interpreter only', ['-c', 'pass']),
+    ('import csv2docx', ['-c', 'import csv2docx; ' + HEAVY_CHECK]),
+    ('csv2docx.py --help', ['csv2docx.py', '--help']),
+    ('settings validation', ['-c', 'import csv2docx; s = csv2docx.MySettings(); '
+                                   's.read_json_file(%r); %s' % (JSON_FILE,
+                                                                 HEAVY_CHECK)]),
+]
+
+
+def time_command(args, runs):
+    best = None
+    heavy = ''
+    for run in xrange(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + args, cwd=ROOT_FOLDER,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        heavy = process.communicate()[1]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, heavy
+
+
+def main(runs=10):
+    for label, args in COMMANDS:
+        best, heavy = time_command(args, runs)
+        print '%-22s %7.1f ms (best of %d)  %s' % (label, best * 1000, runs,
+                                                   heavy.strip())
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,152 @@
+"""
+End-to-end and per-stage throughput benchmarks on synthetic csv files.
+
+Each scenario generates a csv (see synthetic.py), converts it in a fresh
+process with the StageProfiler installed, and records rows/sec, peak RSS,
+output size and the time spent in each stage.
+
+Usage:
+    python test/bench_suite.py                  # run and print results
+    python test/bench_suite.py --scale 5        # 5x the rows of each scenario
+    python test/bench_suite.py --save-baseline  # store results as the baseline
+    python test/bench_suite.py --check          # fail on regressions vs baseline
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+import csv2docx
+from synthetic import write_synthetic_csv
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+BASELINE_FILE = os.path.join(THIS_FOLDER, 'bench_baseline.json')
+
+SCENARIOS = {
+    'small':      dict(num_rows=1000),
+    'medium':     dict(num_rows=20000),
+    'xref_heavy': dict(num_rows=20000, xref_density=8.0),
+    'headings':   dict(num_rows=20000, heading_density=0.5),
+    'unicode':    dict(num_rows=20000, unicode_mix=0.3),
+    'images':     dict(num_rows=5000, image_density=0.2),
+}
+CONVERT_OPTIONS = {
+    'default':   {},
+    'streaming': dict(streaming=True, stream_docx=True),
+    'pipeline':  dict(pipeline=True),
+}
+
+
+def run_scenario(params, options, folder, results):
+    """ Runs in a child process so peak RSS belongs to this scenario alone """
+    input_file = os.path.join(folder, 'input.csv')
+    output_file = os.path.join(folder, 'output.docx')
+    write_synthetic_csv(input_file, **params)
+
+    settings = csv2docx.MySettings()
+    settings.read_json_file(JSON_FILE)
+    profiler = csv2docx.StageProfiler()
+    profiler.install()
+    start = time.time()
+    # test_settings.json sets debug; the trace's I/O isn't what is measured
+    csv2docx.convert(settings, input_file, output_file, debug_csv=False,
+                     **options)
+    seconds = time.time() - start
+    profiler.uninstall()
+
+    results.put({'num_rows': params['num_rows'],
+                 'rows_per_sec': params['num_rows'] / seconds,
+                 'seconds': seconds,
+                 'peak_rss_kb': csv2docx.peak_rss_kb(),
+                 'output_bytes': os.path.getsize(output_file),
+                 'stages': dict((stage, entry['wall_seconds'])
+                                for stage, entry in profiler.stages.items())})
+
+
+def run_all(scale=1.0):
+    results = {}
+    for scenario, params in sorted(SCENARIOS.items()):
+        params = dict(params, num_rows=int(params['num_rows'] * scale))
+        for option_name, options in sorted(CONVERT_OPTIONS.items()):
+            folder = tempfile.mkdtemp()
+            queue = multiprocessing.Queue()
+            try:
+                process = multiprocessing.Process(
+                    target=run_scenario, args=(params, options, folder, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+            finally:
+                shutil.rmtree(folder)
+            name = '%s/%s' % (scenario, option_name)
+            results[name] = result
+            print '%-22s %8d rows %9.0f rows/sec %7d KB peak %9d bytes' % (
+                name, params['num_rows'], result['rows_per_sec'],
+                result['peak_rss_kb'], result['output_bytes'])
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """ Return messages for results worse than baseline by more than threshold """
+    messages = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['num_rows'] != result['num_rows']:
+            continue # Only compare like with like (same --scale)
+        if result['rows_per_sec'] < base['rows_per_sec'] * (1 - threshold):
+            messages.append('%s: %.0f rows/sec vs baseline %.0f' % (
+                name, result['rows_per_sec'], base['rows_per_sec']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + threshold):
+            messages.append('%s: %d KB peak vs baseline %d KB' % (
+                name, result['peak_rss_kb'], base['peak_rss_kb']))
+        if result['output_bytes'] > base['output_bytes'] * (1 + threshold):
+            messages.append('%s: %d output bytes vs baseline %d' % (
+                name, result['output_bytes'], base['output_bytes']))
+    return messages
+
+
+def unchecked(results, baseline):
+    """ Return the names of results regressions had no baseline for """
+    return [name for name, result in sorted(results.items())
+            if baseline.get(name, {}).get('num_rows') != result['num_rows']]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the rows of every scenario')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help='exit 1 if a result regressed beyond --threshold')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed fractional regression')
+    args = parser.parse_args(argv)
+
+    results = run_all(args.scale)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Saved baseline to %s' % args.baseline
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        messages = regressions(results, baseline, args.threshold)
+        for message in messages:
+            print 'REGRESSION: %s' % message
+        for name in unchecked(results, baseline):
+            print 'NOT CHECKED: %s has no baseline at this --scale' % name
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark for token resolution: rows/sec of the per-call regex
+replace_tokens (as it was before the Tokenizer) vs CsvParser.replace_tokens.
+
+Usage: python test/bench_tokens.py [num_rows] [refs_per_row]
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(THIS_FOLDER))
+
+from csv2docx import CsvParser, MySettings
+from synthetic import write_synthetic_csv
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+
+
+def legacy_parse_token(parser, token):
+    s = parser.s
+    token_contents = token[len(s.l_delim):-len(s.r_delim)]
+    parsed = parser.ParsedToken()
+    if re.match('^[#H]\d+$', token_contents):
+        if (token_contents[0:len(s.heading_text_symbol)] ==
+            s.heading_text_symbol):
+            field = 'heading_text'
+        else:
+            field = 'heading_num'
+        parsed.value = getattr(parser.clean_dict[int(token_contents[1:])], field)
+    else:
+        parsed.value = token_contents
+        parsed.is_image = True
+    return parsed
+
+
+def legacy_replace_tokens(parser, body, row_id):
+    s = parser.s
+    result = []
+    esc_seq = '%s[^%s]*%s' % (s.l_delim, s.r_delim, s.r_delim)
+    non_matches = re.split(esc_seq, body)
+    matches = re.findall(esc_seq, body)
+    this_str = ''
+    for i in range(0, len(matches)):
+        this_str += non_matches[i]
+        parsed = legacy_parse_token(parser, matches[i])
+        if parsed.is_image:
+            result.append(this_str)
+            this_str = ''
+            result.append(parsed)
+        else:
+            this_str += parsed.value
+    result.append(this_str)
+    result.append(non_matches[-1])
+    return result
+
+
+def rows_per_second(replace, parser, bodies):
+    start = time.time()
+    for row_id, body in bodies:
+        replace(body, row_id)
+    return len(bodies) / (time.time() - start)
+
+
+def main(num_rows=20000, refs_per_row=8.0):
+    s = MySettings()
+    s.read_json_file(JSON_FILE)
+    handle, s.INPUT_FILE = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        write_synthetic_csv(s.INPUT_FILE, num_rows, xref_density=refs_per_row)
+        parser = CsvParser(s)
+        bodies = [(row_id, parser.clean_dict[row_id].body)
+                  for row_id in parser.ordered_id_list]
+
+        legacy = rows_per_second(
+            lambda body, row_id: legacy_replace_tokens(parser, body, row_id),
+            parser, bodies)
+        current = rows_per_second(parser.replace_tokens, parser, bodies)
+        print 'rows: %d, refs/row: %.1f' % (num_rows, refs_per_row)
+        print 'legacy regex per call: %10.0f rows/sec' % legacy
+        print 'Tokenizer:             %10.0f rows/sec (%.2fx)' % (
+            current, current / legacy)
+    finally:
+        os.remove(s.INPUT_FILE)
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if i else int(arg)
+           for i, arg in enumerate(sys.argv[1:3])])
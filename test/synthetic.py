@@ -0,0 +1,77 @@
+"""
+Synthetic input generation for the csv2docx benchmarks.
+
+Rows follow the layout of test/input.csv and test/test_settings.json:
+ID, ???, HeadingLevel, HeadingNumber, Heading, Body
+"""
+
+import csv
+import os
+import random
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+HEADER = ['ID', '???', 'HeadingLevel', 'HeadingNumber', 'Heading', 'Body']
+WORDS = ('requirement shall the system interface provide a of to and in '
+         'for each value when output input status').split()
+# utf-8 encoded, like the bullets and dashes in test/input.csv
+UNICODE_WORDS = ('\xe2\x9e\xa2', '\xe2\x80\xa2', '\xe2\x88\x92',
+                 'caf\xc3\xa9', '\xce\xbcs', '\xe2\x89\xa4')
+IMAGES = [os.path.join(THIS_FOLDER, 'images', name) for name in
+          ('240px-Smiley.svg.png', '480px-Smiley.svg.png',
+           '600px-Smiley.svg.png')]
+
+
+def write_synthetic_csv(filename, num_rows, heading_density=0.1,
+                        xref_density=0.5, words_per_body=40, unicode_mix=0.0,
+                        image_density=0.0, images=IMAGES, extra_columns=0,
+                        seed=0):
+    """Write num_rows rows to filename and return the list of ids written
+
+    heading_density is the fraction of rows that are headings, and
+    xref_density is the average number of {#N}/{HN} references per body
+    row (always to headings that exist somewhere in the file).  unicode_mix
+    is the fraction of body words that are non-ascii, and image_density the
+    fraction of body rows with an {image} token, picked from images.
+    extra_columns unused columns are appended, like a wide export."""
+    rng = random.Random(seed)
+    heading_ids = []
+    numbers = [0]
+    rows = []
+    for row_id in xrange(num_rows):
+        if not heading_ids or rng.random() < heading_density:
+            level = rng.randint(1, min(len(numbers) + 1, 4))
+            numbers = numbers[:level]
+            numbers += [0] * (level - len(numbers))
+            numbers[-1] += 1
+            heading_num = '.'.join(str(n) for n in numbers)
+            rows.append([str(row_id), '', str(level), heading_num,
+                         'Heading %d' % row_id, ''])
+            heading_ids.append(row_id)
+        else:
+            rows.append([str(row_id), '', '', '', '', None])
+
+    for row in rows:
+        if row[5] is not None:
+            continue
+        words = [rng.choice(UNICODE_WORDS) if rng.random() < unicode_mix
+                 else rng.choice(WORDS)
+                 for i in xrange(words_per_body)]
+        num_refs = int(xref_density) + (rng.random() < xref_density % 1)
+        for i in xrange(num_refs):
+            target = rng.choice(heading_ids)
+            words.insert(rng.randint(0, len(words)),
+                         '{%s%d}' % (rng.choice('#H'), target))
+        if rng.random() < image_density:
+            words.insert(rng.randint(0, len(words)),
+                         '{%s}' % rng.choice(images))
+        row[5] = ' '.join(words)
+
+    with open(filename, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        extra = range(extra_columns)
+        writer.writerow(HEADER + ['Extra %d' % i for i in extra])
+        for row in rows:
+            writer.writerow(row + ['%s-%d' % (row[0], i) for i in extra])
+    return [int(row[0]) for row in rows]
+# end write_synthetic_csv
@@ -0,0 +1,79 @@
+from csv2docx import load_settings, read_manifest, run_batch, main
+import unittest
+import csv2docx
+import os
+import json
+import shutil
+import tempfile
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.manifest = [
+            {'input': DEFAULT_INPUT_FILE, 'output': 'first.docx',
+             'settings': JSON_FILE},
+            {'input': 'missing.csv', 'output': 'missing.docx'},
+            {'input': DEFAULT_INPUT_FILE, 'output': 'second.docx',
+             'settings': JSON_FILE},
+        ]
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_json_manifest(self):
+        manifest_file = os.path.join(self.folder, 'manifest.json')
+        with open(manifest_file, 'w') as f:
+            json.dump(self.manifest, f)
+        return manifest_file
+
+    def test_read_manifest_json_and_csv(self):
+        from_json = read_manifest(self.write_json_manifest(), JSON_FILE)
+
+        csv_manifest = os.path.join(self.folder, 'manifest.csv')
+        with open(csv_manifest, 'w') as f:
+            f.write('input,output,settings\n')
+            for entry in self.manifest:
+                f.write('%s,%s,%s\n' % (entry['input'], entry['output'],
+                                        entry.get('settings', '')))
+        from_csv = read_manifest(csv_manifest, JSON_FILE)
+
+        self.assertEqual(from_json, from_csv)
+        self.assertEqual(from_json[1]['settings'], JSON_FILE)
+        self.assertEqual(from_json[0]['output'],
+                         os.path.join(self.folder, 'first.docx'))
+
+    def test_run_batch_records_failures_and_continues(self):
+        summary = run_batch(read_manifest(self.write_json_manifest(), JSON_FILE))
+        self.assertEqual(summary['total'], 3)
+        self.assertEqual(summary['failed'], 1)
+        statuses = [record['status'] for record in summary['conversions']]
+        self.assertEqual(statuses, ['ok', 'failed', 'ok'])
+        for record in summary['conversions']:
+            self.assertTrue(record['seconds'] >= 0)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'second.docx')))
+
+    def test_cli_options_reach_each_conversion(self):
+        calls = []
+        def recorded_convert(settings, input_file, output_file, **options):
+            calls.append(options)
+            return {}
+        self.addCleanup(setattr, csv2docx, 'convert', csv2docx.convert)
+        csv2docx.convert = recorded_convert
+        main(['--batch', self.write_json_manifest(), '--settings', JSON_FILE,
+              '--summary', os.path.join(self.folder, 'summary.json'),
+              '--pipeline', '--deflate-threads', '3'])
+        self.assertEqual(len(calls), 3)
+        for options in calls:
+            self.assertEqual(options['pipeline'], True)
+            self.assertEqual(options['deflate_threads'], 3)
+
+    def test_load_settings_parses_once(self):
+        self.assertTrue(load_settings(JSON_FILE) is load_settings(JSON_FILE))
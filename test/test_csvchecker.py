@@ -0,0 +1,72 @@
+from csv2docx import CsvChecker, MySettings
+import unittest
+import os
+import csv
+import sys
+import shutil
+import subprocess
+import tempfile
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
+SMILEY = os.path.join(THIS_FOLDER, 'images', '240px-Smiley.svg.png')
+
+
+class TestCsvChecker(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.folder = tempfile.mkdtemp()
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_rows(self, rows):
+        self.s.INPUT_FILE = os.path.join(self.folder, 'input.csv')
+        with open(self.s.INPUT_FILE, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ID', '???', 'HeadingLevel', 'HeadingNumber',
+                             'Heading', 'Body'])
+            writer.writerows(rows)
+        return [(problem['record'], problem['kind'], problem['detail'])
+                for problem in CsvChecker(self.s).check()]
+
+    def test_input_csv_is_clean(self):
+        # input.csv names its images relative to the repository folder
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(os.path.dirname(THIS_FOLDER))
+        self.s.INPUT_FILE = DEFAULT_INPUT_FILE
+        self.assertEqual(CsvChecker(self.s).check(), [])
+
+    def test_reports_every_problem_with_record(self):
+        problems = self.check_rows([
+            ['1', '', '1', '1.', 'Heading', ''],
+            ['2', '', '', '', '', 'See {#1} and {H3}, {#99}, {%s}' % SMILEY],
+            ['3', '', 'x', '2.', 'Bad level', ''],
+            ['2', '', '', '', '', 'Duplicate'],
+            ['four', '', '', '', '', 'Non-int'],
+            ['5', '', '12', '3.', 'Too deep', ''],
+            ['6', '', '', '', '', '{missing.png} and {H7}'],
+            ['7', '', '2', '3.1', 'Forward reference target', ''],
+        ])
+        self.assertEqual(problems, [
+            (2, CsvChecker.DANGLING_REFERENCE, '{#99}'),
+            (3, CsvChecker.BAD_HEADING_LEVEL, "'x'"),
+            (4, CsvChecker.DUPLICATE_ID, ''),
+            (5, CsvChecker.NON_INT_ID, ''),
+            (6, CsvChecker.BAD_HEADING_LEVEL, "'12'"),
+            (7, CsvChecker.MISSING_IMAGE, 'missing.png'),
+        ])
+
+    def test_check_exit_status(self):
+        script = os.path.join(os.path.dirname(THIS_FOLDER), 'csv2docx.py')
+        self.check_rows([['1', '', '', '', '', '{#2}']])
+        status = subprocess.call([sys.executable, script, '--check',
+                                  '--settings', JSON_FILE,
+                                  '--input', self.s.INPUT_FILE],
+                                 stdout=open(os.devnull, 'w'))
+        self.assertEqual(status, 1)
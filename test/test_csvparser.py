@@ -1,4 +1,4 @@
-from csv2docx import CsvParser, MySettings, JsonError, CrossRefError, utils, DocxConfig
+from csv2docx import CsvParser, MySettings, JsonError, CrossRefError, utils, DocxConfig, Tokenizer, RowRecord
 import unittest
 from sys import stderr as err
 import os
@@ -74,7 +74,13 @@ class TestParser(unittest.TestCase):
 
     def test_dont_change_clean_row(self):
         cleaned_row = self.parser.clean_only(self.clean_row[:])
-        self.assertEqual(self.clean_row, cleaned_row)
+        self.assertEqual(RowRecord(6, None, '', '', self.clean_row[5]), cleaned_row)
+
+    def test_clean_only_keeps_configured_columns(self):
+        wide_row = ['3', 'unused', '2', '1.1', 'H2', 'body'] + ['extra'] * 60
+        record = self.parser.clean_only(wide_row)
+        self.assertEqual(record, RowRecord(3, 2, '1.1', 'H2', 'body'))
+        self.assertEqual(len(record), 5)
 
     def test_changes_backslash(self):
         '''At least confirm that \r is 'changed' somehow '''
@@ -160,6 +166,21 @@ class TestParser(unittest.TestCase):
                           inspect.stack()[0][3]))
     # end test_parse_string_with_token
 
+    def test_tokenize_single_pass_stream(self):
+        text = 'a {#7} b {H9}{image.png} c {#7x}'
+        stream = self.s.tokenizer.tokenize(text)
+        self.assertEqual(stream,
+                         ['a ', '#', '7', None,
+                          ' b ', 'H', '9', None,
+                          '', None, None, 'image.png',
+                          ' c ', None, None, '#7x',
+                          ''])
+        self.assertEqual(len(stream) % Tokenizer.STRIDE, 1)
+
+    def test_tokenizer_compiled_once_per_settings(self):
+        other_parser = CsvParser(self.s)
+        self.assertTrue(self.parser.s.tokenizer is other_parser.s.tokenizer)
+
 #     def test_clean_of_special_characters(self):
 #         test_string_slash_n =
 #         test_string_slash_r = test_string_slash_n.replace('\n', '\r')
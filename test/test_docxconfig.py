@@ -1,13 +1,50 @@
-from csv2docx import DocxConfig, utils
+from csv2docx import DocxConfig, StreamingDocxConfig, CsvParser, MySettings, utils, ParagraphBuilder
 import unittest
 from sys import stderr as err
 import os
 import csv
 import inspect
 import time
+import random
+import tempfile
+import shutil
+import zipfile
+from curses import ascii
+from lxml import etree
+import docx
+from PIL import Image
+import csv2docx
 
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
 DEFAULT_INPUT_FILE = list(utils.locator('input.csv'))[0]
 
+
+def legacy_clean(text):
+    """ DocxConfig.clean before the translate table, for comparison """
+    return str(''.join(
+        (ascii.isprint(c) and c) or
+        ((c == '\n' or c == '\r') and '\n') or
+        '?' for c in text
+        ))
+
+
+def random_text(rng, length, max_code):
+    """ Mostly printable text with newlines, controls and high characters """
+    chars = []
+    for i in xrange(length):
+        pick = rng.random()
+        if pick < 0.6:
+            chars.append(rng.randint(0x20, 0x7E))
+        elif pick < 0.7:
+            chars.append(rng.choice((0x9, 0xA, 0xD, 0x0, 0x7F)))
+        else:
+            chars.append(rng.randint(0, max_code))
+    if max_code < 0x100:
+        return ''.join(chr(c) for c in chars)
+    return u''.join(unichr(c) for c in chars)
+
 class TestDocxConfig(unittest.TestCase):
 
     def setUp(self):
@@ -28,4 +65,276 @@ class TestDocxConfig(unittest.TestCase):
         self.assertEqual(test_text.replace('\r', '\n'),
                          DocxConfig.clean(test_text))
 
+    def test_clean_matches_legacy_bytes(self):
+        rng = random.Random(1)
+        for trial in xrange(500):
+            text = random_text(rng, rng.randint(0, 200), 0xFF)
+            self.assertEqual(legacy_clean(text), DocxConfig.clean(text),
+                             msg='Mismatch for %r' % text)
+
+    def test_clean_matches_legacy_unicode(self):
+        rng = random.Random(2)
+        for trial in xrange(500):
+            text = random_text(rng, rng.randint(0, 200), 0xFFFF)
+            cleaned = DocxConfig.clean(text)
+            self.assertEqual(legacy_clean(text), cleaned,
+                             msg='Mismatch for %r' % text)
+            self.assertTrue(isinstance(cleaned, str))
+
+    def test_clean_matches_legacy_every_byte(self):
+        text = ''.join(chr(i) for i in range(256))
+        self.assertEqual(legacy_clean(text), DocxConfig.clean(text))
+        self.assertEqual(legacy_clean(text.decode('latin-1')),
+                         DocxConfig.clean(text.decode('latin-1')))
+
+
+def assert_same_elements(test, expected, actual):
+    """ Compare element trees, ignoring namespace prefixes and whitespace """
+    test.assertEqual(expected.tag, actual.tag)
+    test.assertEqual(dict(expected.attrib), dict(actual.attrib))
+    test.assertEqual((expected.text or '').strip(), (actual.text or '').strip())
+    test.assertEqual(len(expected), len(actual))
+    for expected_child, actual_child in zip(expected, actual):
+        assert_same_elements(test, expected_child, actual_child)
+
+
+class TestStreamingDocxConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.s.INPUT_FILE = DEFAULT_INPUT_FILE
+        handle, self.out_file = tempfile.mkstemp(suffix='.docx')
+        os.close(handle)
+    # end setUp
+
+    def tearDown(self):
+        os.remove(self.out_file)
+
+    def test_streamed_document_matches_tree(self):
+        tree_docx = DocxConfig(self.s)
+        CsvParser(self.s).write_docx(tree_docx)
+
+        streaming_docx = StreamingDocxConfig(self.s)
+        CsvParser(self.s).write_docx(streaming_docx)
+        streaming_docx.save(self.out_file)
+        self.assertFalse(os.path.exists(streaming_docx.body_file.name))
+
+        docx_zip = zipfile.ZipFile(self.out_file)
+        streamed = etree.fromstring(docx_zip.read('word/document.xml'))
+        assert_same_elements(self, tree_docx.document, streamed)
+        for name in ('[Content_Types].xml', 'word/_rels/document.xml.rels',
+                     'word/styles.xml', '_rels/.rels'):
+            self.assertTrue(name in docx_zip.namelist(), msg=name)
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.folder = tempfile.mkdtemp()
+        self.out_file = os.path.join(self.folder, 'out.docx')
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_repeat_images_embedded_once(self):
+        smiley = os.path.join(THIS_FOLDER, 'images', '240px-Smiley.svg.png')
+        smiley_copy = os.path.join(self.folder, 'copy.png')
+        shutil.copyfile(smiley, smiley_copy)
+        other = os.path.join(THIS_FOLDER, 'images', '480px-Smiley.svg.png')
+
+        for docx_class in (DocxConfig, StreamingDocxConfig):
+            out_docx = docx_class(self.s)
+            num_relationships = len(out_docx.relationships)
+            for image_file in (smiley, smiley, other, smiley_copy, smiley):
+                out_docx.add_image(image_file, 'caption')
+            self.assertEqual(out_docx.image_cache.stats(),
+                             {'image_cache_hits': 3, 'image_cache_misses': 2})
+            self.assertEqual(len(out_docx.relationships), num_relationships + 2)
+            out_docx.save(self.out_file)
+
+            media = [name for name in zipfile.ZipFile(self.out_file).namelist()
+                     if name.startswith('word/media/')]
+            self.assertEqual(len(media), 2)
+
+
+class TestParagraphBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.builder = ParagraphBuilder()
+    # end setUp
+
+    def test_paragraph_matches_docx_paragraph(self):
+        for text in ('plain', '', ' leading', 'trailing ', 'a  b',
+                     u'unicode \u2022 bullet', 'x' * 1000):
+            self.assertEqual(etree.tostring(self.builder.paragraph(text)),
+                             etree.tostring(docx.paragraph(text)))
+
+    def test_template_is_not_shared(self):
+        first = self.builder.paragraph(' one')
+        self.builder.paragraph('two')
+        self.assertEqual(etree.tostring(first),
+                         etree.tostring(docx.paragraph(' one')))
+
+    def test_newline_modes(self):
+        body = 'first line\nsecond line\n\n indented'
+        out_docx = DocxConfig(self.s)
+        out_docx.write_paragraph(body, 1)
+        self.assertEqual([etree.tostring(p) for p in out_docx.body],
+                         [etree.tostring(docx.paragraph(line))
+                          for line in body.split('\n')])
+
+        self.s.newline_mode = 'break'
+        out_docx = DocxConfig(self.s)
+        out_docx.write_paragraph(body, 1)
+        self.assertEqual(len(out_docx.body), 1)
+        run = out_docx.body[0][1]
+        self.assertEqual([etree.QName(child).localname for child in run],
+                         ['rPr', 't', 'br', 't', 'br', 't', 'br', 't'])
+        self.assertEqual([t.text for t in run[1::2]],
+                         ['first line', 'second line', None, ' indented'])
+
+
+class TestDocxPackage(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.folder = tempfile.mkdtemp()
+        self.smiley = os.path.join(THIS_FOLDER, 'images', '240px-Smiley.svg.png')
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def saved_zip(self, docx_class=DocxConfig, deflate_threads=1):
+        out_docx = docx_class(self.s)
+        out_docx.deflate_threads = deflate_threads
+        for i in range(200):
+            out_docx.write_paragraph('paragraph %d of the test document' % i, i)
+        out_docx.add_image(self.smiley, 'caption')
+        out_file = tempfile.mktemp(suffix='.docx', dir=self.folder)
+        out_docx.save(out_file)
+        docx_zip = zipfile.ZipFile(out_file)
+        self.assertEqual(docx_zip.testzip(), None)
+        return docx_zip
+    # end saved_zip
+
+    def compress_types(self, docx_zip):
+        return dict((info.filename.split('_')[0], info.compress_type)
+                    for info in docx_zip.infolist())
+
+    def test_levels_and_stored_media(self):
+        default_zip = self.saved_zip()
+        types = self.compress_types(default_zip)
+        self.assertEqual(types['word/document.xml'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types['word/media/rId7'], zipfile.ZIP_STORED)
+        with open(self.smiley, 'rb') as f:
+            self.assertEqual(default_zip.read('word/media/rId7_240px-Smiley.svg.png'),
+                             f.read())
+
+        for docx_class in (DocxConfig, StreamingDocxConfig):
+            self.s.deflate_levels = {}
+            self.s.store_compressed_media = True
+            expected = self.saved_zip(docx_class).read('word/document.xml')
+            self.s.deflate_levels = {'document': 0, 'xml': 1}
+            self.s.store_compressed_media = False
+            docx_zip = self.saved_zip(docx_class)
+            types = self.compress_types(docx_zip)
+            self.assertEqual(types['word/document.xml'], zipfile.ZIP_STORED)
+            self.assertEqual(types['word/media/rId7'], zipfile.ZIP_DEFLATED)
+            self.assertEqual(types['word/styles.xml'], zipfile.ZIP_DEFLATED)
+            self.assertEqual(docx_zip.read('word/document.xml'), expected)
+
+    def test_threaded_document_deflate(self):
+        self.addCleanup(setattr, csv2docx, 'DEFLATE_BLOCK', csv2docx.DEFLATE_BLOCK)
+        csv2docx.DEFLATE_BLOCK = 1000 # Many blocks
+        for docx_class in (DocxConfig, StreamingDocxConfig):
+            expected = self.saved_zip(docx_class).read('word/document.xml')
+            docx_zip = self.saved_zip(docx_class, deflate_threads=3)
+            self.assertEqual(docx_zip.read('word/document.xml'), expected)
+
+    def test_bad_level_exits(self):
+        with self.assertRaises(SystemExit):
+            MySettings().validate_set_json_dict(
+                dict(self.s.__dict__, deflate_levels={'media': 12}))
+
+
+class TestImagePreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.folder = tempfile.mkdtemp()
+        self.s.image_cache_dir = os.path.join(self.folder, 'cache')
+        self.smiley = os.path.join(THIS_FOLDER, 'images', '600px-Smiley.svg.png')
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(csv2docx.ImagePreprocessor.from_settings(self.s), None)
+        self.assertEqual(DocxConfig(self.s).images, None)
+
+    def test_downscale_to_page_width_and_dpi(self):
+        self.s.image_max_width = 2 # Inches: 144 points
+        self.s.image_max_dpi = 100
+        images = csv2docx.ImagePreprocessor.from_settings(self.s)
+        image_file, size = images.get(self.smiley)
+        self.assertEqual(size, (144, 144))
+        self.assertEqual(Image.open(image_file).size, (200, 200))
+        self.assertTrue(image_file.startswith(self.s.image_cache_dir))
+
+        out_docx = DocxConfig(self.s)
+        out_docx.add_image(self.smiley, 'caption')
+        extent = out_docx.body[-1].xpath('.//wp:extent', namespaces=docx.nsprefixes)[0]
+        self.assertEqual(extent.get('cx'), str(144 * 12700))
+        self.assertEqual(out_docx.imagefiledict.keys(), [image_file])
+
+    def test_cache_reused_and_keyed_on_settings(self):
+        self.s.image_max_pixels = 100
+        image_file, size = csv2docx.ImagePreprocessor(self.s).get(self.smiley)
+        mtime = os.path.getmtime(image_file)
+        time.sleep(0.01)
+        self.assertEqual(csv2docx.ImagePreprocessor(self.s).get(self.smiley),
+                         (image_file, size))
+        self.assertEqual(os.path.getmtime(image_file), mtime)
+
+        self.s.image_max_pixels = 50
+        other_file, other_size = csv2docx.ImagePreprocessor(self.s).get(self.smiley)
+        self.assertNotEqual(other_file, image_file)
+        self.assertEqual(Image.open(other_file).size, (50, 50))
+        self.assertEqual(other_size, (600, 600)) # Still shown at full size
+
+    def test_small_image_left_alone(self):
+        self.s.image_max_width = 10
+        small = os.path.join(THIS_FOLDER, 'images', '240px-Smiley.svg.png')
+        images = csv2docx.ImagePreprocessor(self.s)
+        self.assertEqual(images.get(small), (small, (240, 240)))
+
+    def test_jpeg_reencode_flattens_alpha(self):
+        self.s.image_format = 'jpeg'
+        image_file, size = csv2docx.ImagePreprocessor(self.s).get(self.smiley)
+        self.assertTrue(image_file.endswith('.jpg'))
+        image = Image.open(image_file)
+        self.assertEqual((image.format, image.mode), ('JPEG', 'RGB'))
 
+    def test_pool_matches_inline(self):
+        self.s.image_max_pixels = 100
+        documents = []
+        for image_jobs in (1, 2):
+            output_file = os.path.join(self.folder, 'out%d.docx' % image_jobs)
+            csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file,
+                             debug_csv=False, image_jobs=image_jobs)
+            docx_zip = zipfile.ZipFile(output_file)
+            for name in docx_zip.namelist():
+                if name.startswith('word/media/'):
+                    self.assertTrue(max(Image.open(docx_zip.open(name)).size) <= 100)
+            documents.append(docx_zip.read('word/document.xml'))
+        self.assertEqual(documents[0], documents[1])
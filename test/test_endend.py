@@ -1,16 +1,26 @@
-from csv2docx import CsvParser, MySettings, JsonError, CrossRefError, utils, DocxConfig
+from csv2docx import CsvParser, MySettings, JsonError, CrossRefError, utils, DocxConfig, FragmentCache, DebugRows
 import unittest
 from sys import stderr as err
 import os
+import re
 import csv
 import inspect
 import time
+import shutil
+import tempfile
+import zipfile
+import threading
+import subprocess
+import sys
+from lxml import etree
+import csv2docx
 
 THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
 
 JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
 DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
 DEFAULT_OUTPUT_FILE = os.path.join(THIS_FOLDER, 'output.docx')
+TIMESTAMP = r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ'
 
 
 class TestEndEnd(unittest.TestCase):
@@ -28,6 +38,9 @@ class TestEndEnd(unittest.TestCase):
         pass
 
     def test_produces_output(self):
+        # input.csv names its images relative to the repository folder
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(os.path.dirname(THIS_FOLDER))
         out_docx = DocxConfig(self.s)
 
         self.parser.write_docx(out_docx)
@@ -38,7 +51,521 @@ class TestEndEnd(unittest.TestCase):
         num_seconds = 3
         self.assertTrue(time.time() - os.stat(self.s.OUTPUT_FILE).st_mtime <
                         num_seconds)
+        self.assertEqual(out_docx.image_cache.misses, 2)
 
+    def test_missing_image_and_note_are_logged(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        note_input = os.path.join(output_dir, 'input.csv')
+        with open(note_input, 'w') as f:
+            f.write('ID,???,HeadingLevel,HeadingNumber,Heading,Body\n'
+                    '1,,1,1.,H1,\n'
+                    '2,,,,,See {nothere.png} and {TBD} here\n')
+        for options in (dict(), dict(jobs=2), dict(pipeline=True)):
+            output_file = os.path.join(output_dir, 'out.docx')
+            stats = csv2docx.convert(self.s, note_input, output_file,
+                                     debug_csv=False, **options)
+            self.assertEqual(stats['image_cache_misses'], 0)
+            with zipfile.ZipFile(output_file) as docx_zip:
+                self.assertTrue('here' in docx_zip.read('word/document.xml'))
 
+    def test_streaming_matches_in_memory(self):
+        in_memory_docx = DocxConfig(self.s)
+        self.parser.write_docx(in_memory_docx)
 
+        streaming_docx = DocxConfig(self.s)
+        CsvParser(self.s, streaming=True).write_docx(streaming_docx)
 
+        self.assertEqual(etree.tostring(in_memory_docx.document),
+                         etree.tostring(streaming_docx.document))
+
+    def test_streaming_keeps_only_xref_index(self):
+        streaming_parser = CsvParser(self.s, streaming=True)
+        self.assertEqual(streaming_parser.clean_dict, None)
+        self.assertEqual(set(streaming_parser.known_ids),
+                         set(self.parser.get_clean_dict().keys()))
+        # Only heading rows carry heading number/text in input.csv
+        self.assertEqual(len(streaming_parser.xref_index), 6)
+        # The duplicate check's set of ids is the one kept, not a copy
+        seen_ids = set()
+        rows = list(streaming_parser.iter_csv_rows(seen_ids=seen_ids))
+        self.assertEqual(seen_ids, set(int_key for _, int_key, _ in rows))
+        self.assertEqual(seen_ids, streaming_parser.known_ids)
+
+    def test_parallel_matches_serial(self):
+        serial_docx = DocxConfig(self.s)
+        self.parser.write_docx(serial_docx)
+
+        # Small chunks so rows are spread over several workers
+        self.addCleanup(setattr, csv2docx, 'PARALLEL_CHUNK_ROWS',
+                        csv2docx.PARALLEL_CHUNK_ROWS)
+        csv2docx.PARALLEL_CHUNK_ROWS = 4
+        for streaming in (False, True):
+            parallel_docx = DocxConfig(self.s)
+            CsvParser(self.s, streaming=streaming).write_docx(parallel_docx,
+                                                              jobs=2)
+            self.assertEqual(etree.tostring(serial_docx.document),
+                             etree.tostring(parallel_docx.document))
+            self.assertEqual(serial_docx.relationships,
+                             parallel_docx.relationships)
+
+    def test_fragment_cache_rerenders_only_changed_rows(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        serial_docx = DocxConfig(self.s)
+        self.parser.write_docx(serial_docx)
+        num_rows = len(self.parser.ordered_id_list)
+
+        for expected_misses in (num_rows, 0):
+            cached_docx = DocxConfig(self.s)
+            cache = FragmentCache(cache_dir)
+            CsvParser(self.s).write_docx(cached_docx, cache=cache)
+            self.assertEqual(cache.stats(),
+                             {'fragment_cache_hits': num_rows - expected_misses,
+                              'fragment_cache_misses': expected_misses})
+            self.assertEqual(etree.tostring(serial_docx.document),
+                             etree.tostring(cached_docx.document))
+
+        # Renaming heading 7 dirties it and row 6, which references {H7}
+        changed_input = os.path.join(cache_dir, 'input.csv')
+        with open(DEFAULT_INPUT_FILE) as f:
+            text = f.read()
+        with open(changed_input, 'w') as f:
+            f.write(text.replace('7,,2,1.1,H2,', '7,,2,1.1,Renamed,'))
+        self.s.INPUT_FILE = changed_input
+        cache = FragmentCache(cache_dir)
+        changed_docx = DocxConfig(self.s)
+        CsvParser(self.s).write_docx(changed_docx, cache=cache)
+        self.assertEqual(cache.misses, 2)
+        self.assertTrue('Renamed' in etree.tostring(changed_docx.document))
+
+    def test_newline_mode_change_rerenders(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        cache_dir = os.path.join(output_dir, 'cache')
+        output_file = os.path.join(output_dir, 'out.docx')
+        # Row 13 of input.csv has a body over several lines
+        documents = {}
+        for mode in ('paragraph', 'break'):
+            self.s.newline_mode = mode
+            csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file,
+                             cache_dir=cache_dir, debug_csv=False)
+            with zipfile.ZipFile(output_file) as docx_zip:
+                documents[mode] = docx_zip.read('word/document.xml')
+        self.assertFalse(':br' in documents['paragraph'])
+        self.assertTrue(':br' in documents['break'])
+
+        self.s.INPUT_FILE = DEFAULT_INPUT_FILE
+        self.s.OUTPUT_FILE = output_file
+        checkpoint_dir = os.path.join(output_dir, 'checkpoint')
+        out_docx = DocxConfig(self.s)
+        out_docx.journal = []
+        csv2docx.Checkpoint(checkpoint_dir, self.s).save(0, out_docx)
+        self.s.newline_mode = 'paragraph'
+        with self.assertRaises(SystemExit):
+            csv2docx.Checkpoint(checkpoint_dir, self.s).restore(DocxConfig(self.s))
+
+    def test_split_matches_single_document(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        # Row 40 lands in the second chapter and refers back to the first
+        split_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, split_input)
+        with open(split_input, 'a') as f:
+            f.write('40,,,,,See {#9} {H9}\n')
+        self.s.INPUT_FILE = split_input
+        single_docx = DocxConfig(self.s)
+        CsvParser(self.s).write_docx(single_docx)
+        w_t = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t'
+        def texts_of(body):
+            return [''.join(t.text or '' for t in p.iter(w_t)) for p in body]
+        expected = texts_of(single_docx.body)
+
+        for level, num_files in ((1, 2), (2, 4)):
+            for jobs in (1, 2):
+                output_file = os.path.join(output_dir, 'out%d.docx' % jobs)
+                output_files, stats = CsvParser(self.s).write_docx_split(
+                    output_file, level, jobs=jobs)
+                self.assertEqual(output_files,
+                                 [os.path.join(output_dir, 'out%d-%02d.docx' %
+                                               (jobs, n))
+                                  for n in xrange(1, num_files + 1)])
+                texts = []
+                for section_file in output_files:
+                    with zipfile.ZipFile(section_file) as docx_zip:
+                        document = etree.fromstring(
+                            docx_zip.read('word/document.xml'))
+                    body = document[0]
+                    texts.extend(texts_of(body))
+                self.assertEqual(texts, expected)
+                self.assertTrue('See 1.1.1.1 H4' in texts)
+
+    def test_split_saves_with_deflate_threads(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        threads = []
+        original_save = DocxConfig.save
+        def recorded_save(out_docx, out_file):
+            threads.append(out_docx.deflate_threads)
+            return original_save(out_docx, out_file)
+        self.addCleanup(setattr, DocxConfig, 'save', original_save)
+        DocxConfig.save = recorded_save
+        stats = csv2docx.convert(self.s, DEFAULT_INPUT_FILE,
+                                 os.path.join(output_dir, 'out.docx'),
+                                 split_level=1, deflate_threads=2,
+                                 debug_csv=False)
+        self.assertEqual(threads, [2] * len(stats['output_files']))
+
+    def test_split_rejects_cache_dir(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        with self.assertRaises(SystemExit):
+            csv2docx.convert(self.s, DEFAULT_INPUT_FILE,
+                             os.path.join(output_dir, 'out.docx'), split_level=1,
+                             cache_dir=os.path.join(output_dir, 'cache'),
+                             debug_csv=False)
+        self.assertEqual(os.listdir(output_dir), [])
+
+    def test_failed_split_section_leaves_no_temp_file(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        dangling_input = os.path.join(output_dir, 'input.csv')
+        with open(dangling_input, 'w') as f:
+            f.write('ID,???,HeadingLevel,HeadingNumber,Heading,Body\n'
+                    '1,,1,1.,H1,\n'
+                    '2,,,,,See {#99}\n')
+        temp_dir = os.path.join(output_dir, 'tmp')
+        os.mkdir(temp_dir)
+        self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+        tempfile.tempdir = temp_dir
+        with self.assertRaises(CrossRefError):
+            csv2docx.convert(self.s, dangling_input,
+                             os.path.join(output_dir, 'out.docx'), split_level=1,
+                             stream_docx=True, debug_csv=False)
+        self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_debug_trace_reuses_resolved_tokens(self):
+        calls = []
+        original_replace_tokens = CsvParser.replace_tokens
+        def counted_replace_tokens(parser, body, row_id):
+            calls.append(row_id)
+            return original_replace_tokens(parser, body, row_id)
+        self.addCleanup(setattr, CsvParser, 'replace_tokens',
+                        original_replace_tokens)
+        CsvParser.replace_tokens = counted_replace_tokens
+
+        body_ids = [row_id for row_id in self.parser.ordered_id_list
+                    if self.parser.clean_dict[row_id].level is None]
+        traces = []
+        for options in ({}, {'jobs': 2}):
+            trace = DebugRows()
+            del calls[:]
+            self.parser.write_docx(DocxConfig(self.s), debug_writer=trace,
+                                   **options)
+            traces.append(trace)
+            if not options:
+                self.assertEqual(calls, body_ids) # Once per body row
+        self.assertEqual(traces[0], traces[1])
+        self.assertEqual([row[0] for row in traces[0]],
+                         self.parser.ordered_id_list)
+
+    def test_write_docx_accepts_old_debug_keyword(self):
+        expected_docx = DocxConfig(self.s)
+        self.parser.write_docx(expected_docx)
+        out_docx = DocxConfig(self.s)
+        self.parser.write_docx(out_docx, debug=True)
+        self.assertEqual(etree.tostring(out_docx.document),
+                         etree.tostring(expected_docx.document))
+
+    def test_convert_writes_debug_trace_per_output(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output_file = os.path.join(output_dir, 'out.docx')
+        self.assertTrue(self.s.debug)
+        csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file)
+        with open(os.path.join(output_dir, 'out.debug.csv'), 'rb') as f:
+            trace = list(csv.reader(f))
+        self.assertEqual(len(trace), len(self.parser.ordered_id_list))
+
+        os.remove(os.path.join(output_dir, 'out.debug.csv'))
+        csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file,
+                         debug_csv=False)
+        self.assertEqual(os.listdir(output_dir), ['out.docx'])
+
+    def test_resume_matches_uninterrupted_run(self):
+        def xml_items(data):
+            # The streaming writer serializes without indentation
+            return [(el.tag, sorted(el.attrib.items()), (el.text or '').strip())
+                    for el in etree.fromstring(data).iter()]
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        checkpoint_dir = os.path.join(output_dir, 'checkpoint')
+        expected_file = os.path.join(output_dir, 'expected.docx')
+        output_file = os.path.join(output_dir, 'resumed.docx')
+        csv2docx.convert(self.s, DEFAULT_INPUT_FILE, expected_file,
+                         debug_csv=False)
+
+        self.addCleanup(setattr, csv2docx, 'CHECKPOINT_ROWS',
+                        csv2docx.CHECKPOINT_ROWS)
+        csv2docx.CHECKPOINT_ROWS = 3
+        rendered = []
+        original_output = CsvParser.output_clean_row_to_docx
+        def failing_output(parser, row, *args):
+            if row.id == 13 and fail[0]: # After the first image, at row 11 of 14
+                raise CrossRefError('Simulated failure')
+            rendered.append(row.id)
+            return original_output(parser, row, *args)
+        self.addCleanup(setattr, CsvParser, 'output_clean_row_to_docx',
+                        original_output)
+        CsvParser.output_clean_row_to_docx = failing_output
+
+        for stream_docx in (False, True):
+            fail = [True]
+            with self.assertRaises(CrossRefError):
+                csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file,
+                                 debug_csv=False, stream_docx=stream_docx,
+                                 checkpoint_dir=checkpoint_dir)
+            fail[0] = False
+            del rendered[:]
+            csv2docx.convert(self.s, DEFAULT_INPUT_FILE, output_file,
+                             debug_csv=False, stream_docx=stream_docx,
+                             checkpoint_dir=checkpoint_dir, resume=True)
+            # Rows 1-9 were saved; the rest are rendered again
+            self.assertEqual(rendered, self.parser.ordered_id_list[9:])
+            self.assertEqual(os.listdir(checkpoint_dir), [])
+            with zipfile.ZipFile(expected_file) as expected_zip:
+                with zipfile.ZipFile(output_file) as output_zip:
+                    for name in ('word/document.xml',
+                                 'word/_rels/document.xml.rels'):
+                        self.assertEqual(xml_items(expected_zip.read(name)),
+                                         xml_items(output_zip.read(name)))
+                    self.assertEqual(sorted(expected_zip.namelist()),
+                                     sorted(output_zip.namelist()))
+
+    def test_resume_refuses_changed_input(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        checkpoint_dir = os.path.join(output_dir, 'checkpoint')
+        changed_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, changed_input)
+        self.s.INPUT_FILE = changed_input
+        self.s.OUTPUT_FILE = os.path.join(output_dir, 'out.docx')
+        checkpoint = csv2docx.Checkpoint(checkpoint_dir, self.s)
+        out_docx = DocxConfig(self.s)
+        out_docx.journal = []
+        checkpoint.save(0, out_docx)
+
+        with open(changed_input, 'a') as f:
+            f.write('99,,,,,Added\n')
+        with self.assertRaises(SystemExit):
+            csv2docx.Checkpoint(checkpoint_dir, self.s).restore(DocxConfig(self.s))
+
+    def test_resume_refuses_changed_image_settings(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        checkpoint_dir = os.path.join(output_dir, 'checkpoint')
+        self.s.OUTPUT_FILE = os.path.join(output_dir, 'out.docx')
+        self.s.image_cache_dir = os.path.join(output_dir, 'images')
+        self.s.image_max_pixels = 100
+        out_docx = DocxConfig(self.s)
+        out_docx.journal = []
+        csv2docx.Checkpoint(checkpoint_dir, self.s).save(0, out_docx)
+        csv2docx.Checkpoint(checkpoint_dir, self.s).restore(DocxConfig(self.s))
+
+        # Pictures restored from the checkpoint were sized for 100 pixels
+        self.s.image_max_pixels = 200
+        with self.assertRaises(SystemExit):
+            csv2docx.Checkpoint(checkpoint_dir, self.s).restore(DocxConfig(self.s))
+
+    def test_pipeline_matches_serial(self):
+        serial_docx = DocxConfig(self.s)
+        self.parser.write_docx(serial_docx)
+
+        # Small queues and chunks so every stage waits on the next
+        for name, value in (('PIPELINE_CHUNK_ROWS', 2), ('PIPELINE_QUEUE_CHUNKS', 1),
+                            ('DEFLATE_CHUNK', 100)):
+            self.addCleanup(setattr, csv2docx, name, getattr(csv2docx, name))
+            setattr(csv2docx, name, value)
+        for streaming in (False, True):
+            pipelined_docx = DocxConfig(self.s)
+            CsvParser(self.s, streaming=streaming).write_docx(pipelined_docx,
+                                                              pipeline=True)
+            self.assertEqual(etree.tostring(serial_docx.document),
+                             etree.tostring(pipelined_docx.document))
+            self.assertEqual(serial_docx.relationships,
+                             pipelined_docx.relationships)
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        streamed_file = os.path.join(output_dir, 'streamed.docx')
+        pipelined_file = os.path.join(output_dir, 'pipelined.docx')
+        csv2docx.convert(self.s, DEFAULT_INPUT_FILE, streamed_file,
+                         stream_docx=True, debug_csv=False)
+        csv2docx.convert(self.s, DEFAULT_INPUT_FILE, pipelined_file,
+                         pipeline=True, debug_csv=False)
+        with zipfile.ZipFile(streamed_file) as streamed_zip:
+            with zipfile.ZipFile(pipelined_file) as pipelined_zip:
+                self.assertEqual(pipelined_zip.testzip(), None)
+                self.assertEqual(sorted(streamed_zip.namelist()),
+                                 sorted(pipelined_zip.namelist()))
+                for name in streamed_zip.namelist():
+                    # core.xml is stamped with the second each file was saved
+                    self.assertEqual(re.sub(TIMESTAMP, '', streamed_zip.read(name)),
+                                     re.sub(TIMESTAMP, '', pipelined_zip.read(name)))
+
+    def test_failed_streamed_run_exits_with_error(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        dangling_input = os.path.join(output_dir, 'input.csv')
+        with open(dangling_input, 'w') as f:
+            f.write('ID,???,HeadingLevel,HeadingNumber,Heading,Body\n'
+                    '1,,1,1.,H1,\n'
+                    '2,,,,,See {#99}\n')
+        output_file = os.path.join(output_dir, 'out.docx')
+        for options in (['--stream-docx'], ['--pipeline'],
+                        ['--ids', '2', '--stream-docx']):
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(THIS_FOLDER),
+                                              'csv2docx.py'),
+                 '--input', dangling_input, '--output', output_file,
+                 '--settings', JSON_FILE, '--no-debug-csv'] + options,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            # A traceback and status 1, not a crash on the open xml writer
+            self.assertEqual(process.returncode, 1, output)
+            self.assertTrue('CrossRefError' in output)
+            self.assertFalse(os.path.exists(output_file))
+
+    def test_pipeline_error_stops_threads(self):
+        original_replace_tokens = CsvParser.replace_tokens
+        def failing_replace_tokens(parser, body, row_id):
+            if row_id == 13:
+                raise CrossRefError('Simulated failure')
+            return original_replace_tokens(parser, body, row_id)
+        self.addCleanup(setattr, CsvParser, 'replace_tokens',
+                        original_replace_tokens)
+        CsvParser.replace_tokens = failing_replace_tokens
+        self.addCleanup(setattr, csv2docx, 'PIPELINE_QUEUE_CHUNKS',
+                        csv2docx.PIPELINE_QUEUE_CHUNKS)
+        csv2docx.PIPELINE_QUEUE_CHUNKS = 1
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        threads = threading.active_count()
+        with self.assertRaises(CrossRefError):
+            csv2docx.convert(self.s, DEFAULT_INPUT_FILE,
+                             os.path.join(output_dir, 'out.docx'),
+                             pipeline=True, debug_csv=False)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(os.listdir(output_dir), [])
+
+    def test_export_rows_matches_full_document(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        export_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, export_input)
+        self.s.INPUT_FILE = export_input
+        output_file = os.path.join(output_dir, 'out.docx')
+        w_t = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t'
+        def texts_of(body):
+            return [''.join(t.text or '' for t in p.iter(w_t)) for p in body]
+        def expected_texts(row_ids):
+            out_docx = DocxConfig(self.s)
+            self.parser.out_docx = out_docx
+            for row_id in self.parser.ordered_id_list:
+                if row_id in row_ids:
+                    self.parser.output_row_to_docx(row_id)
+            return texts_of(out_docx.body)
+
+        # Section 1.1.1 runs from heading 3 up to the next level 1 heading, 23;
+        # row 6 refers to headings 7 and 9, which are outside --ids 6,13-14
+        order = self.parser.ordered_id_list
+        for options, row_ids in (
+                (dict(section='1.1.1'), order[order.index(3):order.index(23)]),
+                (dict(ids=[(6, 6), (13, 14)]), [6, 13, 14])):
+            stats = csv2docx.export_rows(self.s, export_input, output_file,
+                                         debug_csv=False, **options)
+            self.assertEqual(stats['rows'], len(row_ids))
+            with zipfile.ZipFile(output_file) as docx_zip:
+                body = etree.fromstring(docx_zip.read('word/document.xml'))[0]
+            self.assertEqual(texts_of(body), expected_texts(set(row_ids)))
+        self.assertTrue(os.path.exists(export_input + '.idx'))
+
+    def test_row_index_rebuilds_when_input_changes(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        changed_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, changed_input)
+        self.s.INPUT_FILE = changed_input
+        index = csv2docx.RowIndex(self.s)
+        self.assertEqual(index.id_spans([(99, 99)]), [])
+        index.close()
+
+        with open(changed_input, 'a') as f:
+            f.write('99,,,,,Added {#9}\n')
+        os.utime(changed_input, (0, 0)) # Changed even within the mtime resolution
+        index = csv2docx.RowIndex(self.s)
+        self.addCleanup(index.close)
+        spans = index.id_spans([(99, 99)])
+        self.assertEqual(len(spans), 1)
+        row = list(index.read_rows(spans))[0]
+        self.assertEqual(row[:2], ['99', ''])
+        self.assertEqual(row[5], 'Added {#9}')
+        self.assertEqual(index.get_xref([9, 99]),
+                         (set([9, 99]), {9: ('1.1.1.1', 'H4')}))
+
+    def test_row_index_gives_each_record_its_span(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        quoted_input = os.path.join(output_dir, 'input.csv')
+        with open(quoted_input, 'w') as f:
+            f.write('ID,???,HeadingLevel,HeadingNumber,Heading,Body\n'
+                    '1,,1,1.,H1,\n'
+                    '2,,,,,He is 6" tall\n'
+                    '3,,,,,"Three, quoted"\n'
+                    '4,,,,,Four\n'
+                    '5,,,,,Five\n')
+        output_file = os.path.join(output_dir, 'out.docx')
+        stats = csv2docx.export_rows(self.s, quoted_input, output_file,
+                                     ids=[(2, 4)], debug_csv=False)
+        self.assertEqual(stats['rows'], 3)
+        with zipfile.ZipFile(output_file) as docx_zip:
+            document = docx_zip.read('word/document.xml')
+        for text in ('He is 6" tall', 'Three, quoted', 'Four'):
+            self.assertTrue(text in document)
+
+        # Records that come out of one chunk of lines can't be indexed
+        os.remove(quoted_input + '.idx')
+        self.addCleanup(setattr, csv2docx.CsvRowSource, 'ends_in_quotes',
+                        csv2docx.CsvRowSource.__dict__['ends_in_quotes'])
+        csv2docx.CsvRowSource.ends_in_quotes = staticmethod(
+            lambda line, in_quotes=False: True)
+        self.s.INPUT_FILE = quoted_input
+        with self.assertRaises(SystemExit):
+            csv2docx.RowIndex(self.s)
+
+    def test_export_rejects_options_it_cant_apply(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        export_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, export_input)
+        for options in (['--split', '1'], ['--jobs', '2'], ['--pipeline'],
+                        ['--cache-dir', output_dir],
+                        ['--checkpoint', output_dir]):
+            with self.assertRaises(SystemExit) as raised:
+                csv2docx.main(['--input', export_input, '--settings', JSON_FILE,
+                               '--output', os.path.join(output_dir, 'out.docx'),
+                               '--ids', '1-3'] + options)
+            self.assertEqual(raised.exception.code, 2) # parser.error
+        self.assertEqual(os.listdir(output_dir), ['input.csv'])
+
+    def test_section_not_found_exits(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        export_input = os.path.join(output_dir, 'input.csv')
+        shutil.copy(DEFAULT_INPUT_FILE, export_input)
+        with self.assertRaises(SystemExit):
+            csv2docx.export_rows(self.s, export_input,
+                                 os.path.join(output_dir, 'out.docx'),
+                                 section='7.7', debug_csv=False)
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'out.docx')))
@@ -5,6 +5,9 @@ import os
 import csv
 import inspect
 import time
+import subprocess
+import sys
+import cPickle
 
 THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
 
@@ -37,4 +40,49 @@ class TestMySettings(unittest.TestCase):
         self.assertTrue(s.body_text_ind in s.all_inds)
     # test_all_inds_includes_expected
 
+    def test_validation_does_not_import_docx(self):
+        """ Settings validation stays light; docx/lxml load on first use """
+        code = ('import sys, csv2docx; s = csv2docx.MySettings(); '
+                's.read_json_file(%r); '
+                'print [m for m in ("docx", "lxml", "PIL") if m in sys.modules]'
+                % JSON_FILE)
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(THIS_FOLDER))
+        self.assertEqual(output.strip(), '[]')
 
+    def test_profile_is_frozen_and_shared(self):
+        """ Equal settings give equal, hashable profiles with one Tokenizer """
+        other = MySettings()
+        other.read_json_file(JSON_FILE)
+        profile = self.s.profile
+        self.assertEqual(profile, other.profile)
+        self.assertEqual(hash(profile), hash(other.profile))
+        self.assertTrue(profile.tokenizer is other.profile.tokenizer)
+        self.assertEqual(profile, cPickle.loads(cPickle.dumps(profile, 2)))
+        self.assertEqual(profile.columns, tuple(sorted(set(self.s.all_inds))))
+        with self.assertRaises(AttributeError):
+            profile.l_delim = '['
+    # test_profile_is_frozen_and_shared
+
+    def test_repeated_conversions_stay_flat(self):
+        """ Loading settings again does not grow the work done per row """
+        clean = DocxConfig.__dict__['clean']
+        calls = []
+        def counting_clean(text):
+            calls.append(1)
+            return clean.__func__(text)
+        self.addCleanup(setattr, DocxConfig, 'clean', clean)
+        DocxConfig.clean = staticmethod(counting_clean)
+
+        per_conversion = []
+        for i in range(1000):
+            del calls[:]
+            s = MySettings()
+            s.read_json_file(JSON_FILE)
+            s.INPUT_FILE = DEFAULT_INPUT_FILE
+            CsvParser(s)
+            per_conversion.append(len(calls))
+            self.assertEqual(len(s.all_inds), 5)
+            self.assertEqual(s.profile, self.s.profile)
+        self.assertEqual(set(per_conversion), set([per_conversion[0]]))
+    # test_repeated_conversions_stay_flat
@@ -0,0 +1,70 @@
+from csv2docx import CsvParser, MySettings, DocxConfig, StreamingDocxConfig, StageProfiler, main
+import unittest
+import os
+import json
+import tempfile
+import shutil
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.s.INPUT_FILE = DEFAULT_INPUT_FILE
+        self.folder = tempfile.mkdtemp()
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stages_counted_and_uninstalled(self):
+        original_clean_only = CsvParser.__dict__['clean_only']
+        profiler = StageProfiler()
+        profiler.install()
+        try:
+            parser = CsvParser(self.s)
+            out_docx = DocxConfig(self.s)
+            parser.write_docx(out_docx)
+            out_docx.save(os.path.join(self.folder, 'out.docx'))
+        finally:
+            profiler.uninstall()
+        self.assertTrue(CsvParser.__dict__['clean_only'] is original_clean_only)
+
+        stages = profiler.report()['stages']
+        num_rows = len(parser.ordered_id_list)
+        self.assertEqual(stages['csv_read']['calls'], num_rows)
+        self.assertEqual(stages['clean_only']['calls'], num_rows)
+        self.assertEqual(stages['add_image']['calls'], 2)
+        self.assertEqual(stages['save']['calls'], 1)
+        for stage in stages.values():
+            self.assertTrue(stage['wall_seconds'] >= 0)
+            self.assertTrue(stage['peak_rss_kb'] > 0)
+
+    def test_nested_stage_is_timed_once(self):
+        # StreamingDocxConfig.save calls DocxConfig.save; both are wrapped
+        profiler = StageProfiler()
+        profiler.install()
+        try:
+            out_docx = StreamingDocxConfig(self.s)
+            CsvParser(self.s).write_docx(out_docx)
+            out_docx.save(os.path.join(self.folder, 'out.docx'))
+        finally:
+            profiler.uninstall()
+        self.assertEqual(profiler.report()['stages']['save']['calls'], 1)
+
+    def test_main_writes_json_report_and_dump(self):
+        report_file = os.path.join(self.folder, 'profile.json')
+        dump_file = os.path.join(self.folder, 'profile.pstats')
+        main(['--input', DEFAULT_INPUT_FILE, '--settings', JSON_FILE,
+              '--output', os.path.join(self.folder, 'out.docx'),
+              '--profile', report_file, '--profile-dump', dump_file])
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertTrue('replace_tokens' in report['stages'])
+        self.assertTrue(os.path.getsize(dump_file) > 0)
@@ -0,0 +1,164 @@
+from csv2docx import CsvParser, MySettings, open_row_source, SqliteRowSource, CsvRowSource
+import unittest
+import os
+import csv
+import shutil
+import sqlite3
+import tempfile
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
+
+
+def read_csv_rows(filename):
+    with open(filename, 'rb') as csvfile:
+        return list(csv.reader(csvfile))
+
+def typed(value):
+    """ Cell value as a spreadsheet would store it """
+    try:
+        return int(value)
+    except ValueError:
+        return value.decode('utf-8') or None
+
+
+class TestRowSources(unittest.TestCase):
+
+    def setUp(self):
+        self.s = MySettings()
+        self.s.read_json_file(JSON_FILE)
+        self.s.INPUT_FILE = DEFAULT_INPUT_FILE
+        self.csv_rows = read_csv_rows(DEFAULT_INPUT_FILE)
+        self.folder = tempfile.mkdtemp()
+        self.expected = self.clean_records()
+    # end setUp
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def clean_records(self):
+        parser = CsvParser(self.s)
+        return [parser.clean_dict[row_id] for row_id in parser.ordered_id_list]
+
+    def assert_same_rows(self, input_file, **settings):
+        self.s.INPUT_FILE = input_file
+        for k, v in settings.items():
+            setattr(self.s, k, v)
+        self.assertEqual(self.clean_records(), self.expected)
+
+    def test_csv_source_reads_every_column(self):
+        self.assertEqual(list(open_row_source(self.s)), self.csv_rows)
+
+    def test_mapped_csv_matches_csv_reader(self):
+        tricky = os.path.join(self.folder, 'tricky.csv')
+        with open(tricky, 'wb') as f:
+            f.write('ID,x,Level,Num,Heading,Body,Extra,Extra\r\n'
+                    '1,,1,1.,"Quoted, heading",,a,b\r\n'
+                    '\r\n'
+                    '2,,,,,"Multi\nline ""quoted""\nbody",c,"d\ne"\n'
+                    '3,,,,,plain body,f,g\n'
+                    '4,,,\n'
+                    '5,,,,,lit"eral,h\n'
+                    '6,,,,,after the literal quote\n'
+                    '8,,,,6" wide,"Body, ""quoted"", and\nwrapped",i\n'
+                    '9,,,,,"Ends in an escaped quote """,j\n'
+                    '7,,,,,no newline at the end')
+        self.s.INPUT_FILE = tricky
+        inds = sorted(set(self.s.all_inds))
+        def configured(rows):
+            return [[row[i] if i < len(row) else None for i in inds]
+                    for row in rows]
+        expected = configured(read_csv_rows(tricky))
+        source = CsvRowSource(self.s)
+        chunks = []
+        csv_reader = source.csv_reader
+        source.csv_reader = lambda lines: (chunks.append(len(lines)) or
+                                           csv_reader(lines))
+        self.assertEqual(configured(source), expected)
+        # Only records with a quoted field go to csv.reader, one at a time;
+        # a literal quote (rows 5 and 8) doesn't hold on to the next lines
+        self.assertEqual(chunks, [1, 4, 2, 1])
+        self.s.csv_dialect = 'excel' # csv.reader for the whole file
+        self.assertEqual(list(CsvRowSource(self.s)), read_csv_rows(tricky))
+
+        empty = os.path.join(self.folder, 'empty.csv')
+        open(empty, 'wb').close()
+        self.s.INPUT_FILE = empty
+        self.s.csv_dialect = None
+        self.assertEqual(list(CsvRowSource(self.s)), [])
+
+    def test_csv_dialect(self):
+        tabbed = os.path.join(self.folder, 'input.tsv')
+        with open(tabbed, 'wb') as f:
+            csv.writer(f, dialect='excel-tab').writerows(self.csv_rows)
+        self.assert_same_rows(tabbed, input_format='csv',
+                              csv_dialect='excel-tab')
+        self.assert_same_rows(tabbed, csv_dialect={'delimiter': '\t'})
+
+    def test_sqlite(self):
+        filename = os.path.join(self.folder, 'input.sqlite')
+        connection = sqlite3.connect(filename)
+        header = self.csv_rows[0]
+        columns = ', '.join('c%d' % i for i in xrange(len(header) + 1))
+        connection.execute('CREATE TABLE export (%s)' % columns)
+        # An extra unused column, to check only the configured ones are read
+        connection.executemany(
+            'INSERT INTO export VALUES (%s)' % ', '.join('?' * (len(header) + 1)),
+            [[typed(value) for value in row] + ['unused']
+             for row in self.csv_rows[1:]])
+        connection.commit()
+        connection.close()
+        self.assert_same_rows(filename)
+
+        rows = list(SqliteRowSource(self.s))
+        self.assertEqual(rows[0], ['c0', '', 'c2', 'c3', 'c4', 'c5'])
+
+        self.s.input_query = 'SELECT * FROM export WHERE c0 < 7'
+        self.assertEqual(len(list(SqliteRowSource(self.s))), 1 + sum(
+            1 for row in self.csv_rows[1:] if row[0] and int(row[0]) < 7))
+
+    def test_xlsx(self):
+        try:
+            import openpyxl
+        except ImportError:
+            raise unittest.SkipTest('openpyxl is not installed')
+        filename = os.path.join(self.folder, 'input.xlsx')
+        book = openpyxl.Workbook()
+        sheet = book.active
+        sheet.title = 'export'
+        book.create_sheet('first', 0) # input_sheet picks the right one
+        sheet.append(self.csv_rows[0])
+        for row in self.csv_rows[1:]:
+            sheet.append([typed(value) for value in row])
+        book.save(filename)
+        self.assert_same_rows(filename, input_sheet='export')
+
+    def test_parquet_and_arrow(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise unittest.SkipTest('pyarrow is not installed')
+        header = self.csv_rows[0]
+        header[1] = 'Unused' # Arrow column names need to be distinct
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array([row[i].decode('utf-8') for row in self.csv_rows[1:]])
+             for i in xrange(len(header))], names=header)
+
+        filename = os.path.join(self.folder, 'input.parquet')
+        pyarrow.parquet.write_table(table, filename, row_group_size=5)
+        self.assert_same_rows(filename)
+
+        filename = os.path.join(self.folder, 'input.arrow')
+        with open(filename, 'wb') as sink:
+            writer = pyarrow.RecordBatchFileWriter(sink, table.schema)
+            for batch in table.to_batches(max_chunksize=5):
+                writer.write_batch(batch)
+            writer.close()
+        self.assert_same_rows(filename)
+
+        filename = os.path.join(self.folder, 'export.bin')
+        os.rename(os.path.join(self.folder, 'input.arrow'), filename)
+        self.assert_same_rows(filename, input_format='arrow')
@@ -0,0 +1,76 @@
+import csv2docx_server
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import threading
+import urllib2
+import zipfile
+from StringIO import StringIO
+
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+
+JSON_FILE = os.path.join(THIS_FOLDER, 'test_settings.json')
+DEFAULT_INPUT_FILE = os.path.join(THIS_FOLDER, 'input.csv')
+
+
+class TestConversionServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = csv2docx_server.ConversionServer(('127.0.0.1', 0),
+                                                      JSON_FILE, jobs=2)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        with open(DEFAULT_INPUT_FILE, 'rb') as f:
+            cls.csv_data = f.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, data, query=''):
+        return urllib2.urlopen(self.url + '/convert' + query, data)
+
+    def assert_docx(self, response):
+        self.assertEqual(response.info().getheader('Content-Type'),
+                         csv2docx_server.DOCX_CONTENT_TYPE)
+        docx_zip = zipfile.ZipFile(StringIO(response.read()))
+        self.assertTrue('Text after first heading' in
+                        docx_zip.read('word/document.xml'))
+
+    def test_convert(self):
+        self.assert_docx(self.post(self.csv_data))
+        self.assert_docx(self.post(self.csv_data, '?settings=test_settings'))
+
+    def test_concurrent_requests(self):
+        errors = []
+        def convert():
+            try:
+                self.assert_docx(self.post(self.csv_data))
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=convert) for i in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_errors(self):
+        with self.assertRaises(urllib2.HTTPError) as raised:
+            self.post(self.csv_data, '?settings=../missing')
+        self.assertEqual(raised.exception.code, 400)
+        # A dangling reference fails the conversion, not the server
+        with self.assertRaises(urllib2.HTTPError) as raised:
+            self.post('ID,,,,,Body\n1,,,,,{#99}\n')
+        self.assertEqual(raised.exception.code, 400)
+        with self.assertRaises(urllib2.HTTPError) as raised:
+            urllib2.urlopen(self.url + '/missing')
+        self.assertEqual(raised.exception.code, 404)
+        health = json.load(urllib2.urlopen(self.url + '/health'))
+        self.assertTrue(health['failed'] >= 1)